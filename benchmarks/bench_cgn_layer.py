@@ -0,0 +1,95 @@
+"""
+Throughput and peak memory of CGNLayer, forward + backward, for several batch sizes.
+
+Compares the module with the legacy layer, which permuted the input to (ex, ch, node) and back around the sparse
+product. Each (layer, batch size) runs in its own process, so the peak RSS it reports is its own.
+
+glibc keeps the freed tensors below its mmap threshold (up to 32MB) in the heap, which makes the peak RSS depend on
+the order of the allocations more than on their size. Lower the threshold to compare what the layers really allocate:
+
+    MALLOC_MMAP_THRESHOLD_=1048576 python benchmarks/bench_cgn_layer.py --nb-nodes 4000 --batch-sizes 32 128 512
+"""
+
+import sys, os
+myPath = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, myPath + '/../')
+
+import time
+import resource
+import argparse
+import subprocess
+import numpy as np
+import scipy.sparse
+import torch
+from models.graphLayer import CGNLayer, SparseMM
+
+
+def legacy_forward(layer, x):
+    # CGNLayer.forward as it was before it worked on the (ex, node, ch) layout.
+    x = x.permute(0, 2, 1).contiguous()  # from ex, node, ch, -> ex, ch, node
+    eye_x = layer.eye_linear(x)
+
+    nb_examples, nb_channels, nb_nodes = x.size()
+    x = x.view(-1, nb_nodes)
+    x = SparseMM.apply(layer.sparse_adj, x.t()).t()
+    x = x.contiguous().view(nb_examples, nb_channels, nb_nodes)
+
+    x = torch.cat([layer.linear(x), eye_x], dim=1)
+    return x.permute(0, 2, 1).contiguous()  # from ex, ch, node -> ex, node, ch
+
+
+def current_rss():
+    # In MB, linux only.
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * resource.getpagesize() / 1024 / 1024
+
+
+def run(opt, legacy, batch_size):
+    torch.set_num_threads(opt.nb_threads)
+    # Sparse, so building the graph does not weigh on the peak RSS.
+    adj = scipy.sparse.random(opt.nb_nodes, opt.nb_nodes, density=opt.density, random_state=0, dtype=np.float32)
+
+    torch.manual_seed(0)
+    layer = CGNLayer(adj, in_dim=opt.in_dim, channels=opt.channels)
+    x = torch.randn(batch_size, opt.nb_nodes, opt.in_dim, requires_grad=True)
+    forward = (lambda: legacy_forward(layer, x)) if legacy else (lambda: layer(x))
+
+    start_rss = current_rss()
+    forward().sum().backward()  # warm up
+    start = time.time()
+    for _ in range(opt.nb_calls):
+        forward().sum().backward()
+    elapsed = (time.time() - start) / opt.nb_calls
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # kB on linux
+    print "{:6s} batch {:4d}: {:8.1f} ex/s, peak RSS {:6d} MB, {:6d} MB over the setup".format(
+        'legacy' if legacy else 'module', batch_size, batch_size / elapsed, peak, peak - start_rss)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--nb-nodes', type=int, default=4000)
+    parser.add_argument('--density', type=float, default=0.005)
+    parser.add_argument('--in-dim', type=int, default=16)
+    parser.add_argument('--channels', type=int, default=32)
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[32, 64, 128, 256, 512])
+    parser.add_argument('--nb-calls', type=int, default=3)
+    parser.add_argument('--nb-threads', type=int, default=4)
+    parser.add_argument('--legacy', action='store_true', help="Only run the legacy layer, in this process.")
+    parser.add_argument('--module', action='store_true', help="Only run the module, in this process.")
+    opt = parser.parse_args(argv)
+
+    if opt.legacy or opt.module:
+        for batch_size in opt.batch_sizes:
+            run(opt, opt.legacy, batch_size)
+        return
+
+    argv = sys.argv[1:] if argv is None else list(argv)
+    for batch_size in opt.batch_sizes:
+        for flag in ['--legacy', '--module']:
+            subprocess.check_call([sys.executable, os.path.abspath(__file__)] + argv +
+                                  ['--batch-sizes', str(batch_size), flag])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+"""
+Micro-benchmark of PoolGraph.
+
+Compares the module, whose edges and mask are buffers built once, with the legacy pooling that converted the adj
+and to_keep from numpy (and moved them to the gpu) on every call, and reports that conversion alone.
+
+    python benchmarks/bench_pool_graph.py --nb-nodes 1000 --batch-size 16
+"""
+
+import sys, os
+myPath = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, myPath + '/../')
+
+import time
+import argparse
+import numpy as np
+import torch
+from torch.autograd import Variable
+from models.graphLayer import PoolGraph
+
+
+def legacy_pool(x, adj, to_keep, type='max', on_cuda=False):
+    # The pooling as it was before PoolGraph became a module, the conversions included.
+    adj = Variable(torch.FloatTensor(adj), requires_grad=False)
+    to_keep = Variable(torch.FloatTensor(to_keep.astype(float)), requires_grad=False)
+    if on_cuda:
+        adj = adj.cuda()
+        to_keep = to_keep.cuda()
+
+    x = x.permute(0, 2, 1).contiguous()  # put in ex, channel, node
+    x_shape = x.size()
+
+    if type == 'max':
+        max_value = (x.view(-1, x.size(-1), 1) * adj).max(dim=1)[0]
+    else:
+        max_value = (x.view(-1, x.size(-1), 1) * adj).mean(dim=1)
+
+    retn = max_value * to_keep
+    return retn.view(x_shape).permute(0, 2, 1).contiguous()
+
+
+def timeit(f, nb_calls):
+    f()  # warm up
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    start = time.time()
+    for _ in range(nb_calls):
+        f()
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    return (time.time() - start) / nb_calls * 1000.
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--nb-nodes', type=int, default=1000)
+    parser.add_argument('--density', type=float, default=0.01)
+    parser.add_argument('--batch-size', type=int, default=16)
+    parser.add_argument('--channels', type=int, default=4)
+    parser.add_argument('--nb-calls', type=int, default=10)
+    parser.add_argument('--cuda', action='store_true')
+    opt = parser.parse_args(argv)
+
+    rng = np.random.RandomState(0)
+    adj = (rng.rand(opt.nb_nodes, opt.nb_nodes) < opt.density).astype(float)  # as the AggregationGraph adjs
+    adj = np.maximum(adj, adj.T)
+    np.fill_diagonal(adj, 1.)
+    to_keep = (rng.rand(opt.nb_nodes) < .5).astype(float)
+
+    x = torch.randn(opt.batch_size, opt.nb_nodes, opt.channels)
+    if opt.cuda:
+        x = x.cuda()
+
+    for type in ['max', 'mean']:
+        pool = PoolGraph(adj, to_keep, type=type, on_cuda=opt.cuda)
+        print "{:5s} legacy: {:8.2f} ms/call".format(type, timeit(lambda: legacy_pool(x, adj, to_keep, type, opt.cuda), opt.nb_calls))
+        print "{:5s} module: {:8.2f} ms/call".format(type, timeit(lambda: pool(x), opt.nb_calls))
+
+    def convert():
+        converted = [torch.FloatTensor(adj), torch.FloatTensor(to_keep.astype(float))]
+        if opt.cuda:
+            converted = [tensor.cuda() for tensor in converted]
+    print "numpy -> torch conversion alone, paid by every legacy call: {:.2f} ms".format(timeit(convert, opt.nb_calls))
+
+
+if __name__ == '__main__':
+    main()
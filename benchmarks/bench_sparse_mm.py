@@ -0,0 +1,71 @@
+"""
+Per-call overhead of SparseMM.
+
+Compares the static Function, SparseMM.apply(sparse, dense), with the legacy stateful Function that was built anew
+for every product. Use small matrices to see the overhead, big ones to check the product itself did not change.
+
+    python benchmarks/bench_sparse_mm.py --nb-nodes 20 --nb-columns 5
+"""
+
+import sys, os
+myPath = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, myPath + '/../')
+
+import time
+import argparse
+import numpy as np
+import torch
+from models.graphLayer import SparseMM
+
+
+class LegacySparseMM(torch.autograd.Function):
+    # SparseMM as it was before it became a static Function.
+
+    def __init__(self, sparse):
+        super(LegacySparseMM, self).__init__()
+        self.sparse = sparse
+
+    def forward(self, dense):
+        return torch.mm(self.sparse, dense)
+
+    def backward(self, grad_output):
+        grad_input = None
+        if self.needs_input_grad[0]:
+            grad_input = torch.mm(self.sparse.t(), grad_output)
+        return grad_input
+
+
+def timeit(f, nb_calls):
+    f()  # warm up
+    start = time.time()
+    for _ in range(nb_calls):
+        f()
+    return (time.time() - start) / nb_calls * 1e6
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--nb-nodes', type=int, default=20)
+    parser.add_argument('--density', type=float, default=0.2)
+    parser.add_argument('--nb-columns', type=int, default=5)
+    parser.add_argument('--nb-calls', type=int, default=20000)
+    opt = parser.parse_args(argv)
+
+    rng = np.random.RandomState(0)
+    dense = (rng.rand(opt.nb_nodes, opt.nb_nodes) < opt.density) * rng.rand(opt.nb_nodes, opt.nb_nodes)
+    edges = torch.LongTensor(np.array(np.where(dense)))
+    sparse = torch.sparse.FloatTensor(edges, torch.FloatTensor(dense[np.where(dense)]),
+                                      torch.Size([opt.nb_nodes, opt.nb_nodes]))
+    x = torch.randn(opt.nb_nodes, opt.nb_columns)
+    x_grad = x.clone().requires_grad_()
+
+    print "forward,  legacy: {:8.1f} us/call".format(timeit(lambda: LegacySparseMM(sparse)(x), opt.nb_calls))
+    print "forward,  static: {:8.1f} us/call".format(timeit(lambda: SparseMM.apply(sparse, x), opt.nb_calls))
+    print "backward, legacy: {:8.1f} us/call".format(
+        timeit(lambda: LegacySparseMM(sparse)(x_grad).sum().backward(), opt.nb_calls / 4))
+    print "backward, static: {:8.1f} us/call".format(
+        timeit(lambda: SparseMM.apply(sparse, x_grad).sum().backward(), opt.nb_calls / 4))
+
+
+if __name__ == '__main__':
+    main()
@@ -15,12 +15,14 @@ import colombos_load_data
 
 class EcoliDataset(Dataset):
 
-    def __init__(self):
+    def __init__(self, data_dir="data/colombos_data"):
+        self.data_dir = data_dir
         super(EcoliDataset, self).__init__(name="EcoliDataset", seed=None, nb_class=None, nb_examples=None, nb_nodes=None)
 
     def load_data(self):
 
-        data =  colombos_load_data.load("ecoli", False)
+        # Memory-mapped from the binary cache after the first load.
+        data = colombos_load_data.load("ecoli", False, data_dir=self.data_dir)
         self.raw_data = data
         self.data = data[0]
         self.nb_nodes = self.data.shape[1]
@@ -1,82 +1,119 @@
-import glob
+import fnmatch
+import hashlib
+import logging
 import numpy
 import os
 import pandas
+import scipy.sparse
+import shutil
 import sys
+import tempfile
 import urllib
 import zipfile
+from stats import RunningStats
 
-def load(organism, shared = True, data_dir="data/colombos_data"):
+def load(organism, shared = True, data_dir="data/colombos_data", stats_file = None,
+         mirror_dir = None, offline = False):
     """
     Downloads gene expression data for the specified ogranism from 
     Colombos website (http://www.colombos.net/) and prepares the 
     data for subsequent analysis. 
 
+    The first load converts the text files to a binary cache in
+    data_dir/<organism>_cache_<digest> (see convert), the next ones only
+    open it. Only the three needed members of the zip are read, straight
+    into the cache; nothing is extracted.
+
+    The zip is taken from mirror_dir (or the COLOMBOS_MIRROR environment
+    variable) if given, else from data_dir, where it is downloaded if
+    missing. With offline, an IOError is raised instead of downloading.
+
+    The zip is checked against the <zip>.sha256 file next to it. A mirror
+    must have one. Without one, a zip in data_dir is used with a warning.
+    The cache is keyed on the sha256 of the zip, so a changed zip gets its
+    own cache. An existing cache is trusted as is; its content isn't checked
+    again.
+
+    The expressions are standardized per gene. The statistics are saved to
+    stats_file if given, or loaded from it if it already exists.
+
     Returns:
       expressions - M by N matrix, where M is the number of contrasts and N is
                     the number of genes. The matrix is/isn't Theano shared
-                    if shared is True/False.
+                    if shared is True/False. Otherwise it is a read-only
+                    float32 memory-mapped array, unless stats_file is used.
       contrasts   - a list of M contrast identifiers.
       genes       - a list of N gene names.
-      refannot    - a dictionary mapping contrast identifiers to a set of 
-                    reference conditions.
-      testannot   - a dictionary mapping contrast identifiers to a set of 
-                    test conditions.
+      refannot    - an AnnotationIndex of the reference conditions. It
+                    behaves like a dictionary mapping contrast identifiers
+                    to a set of conditions.
+      testannot   - an AnnotationIndex of the test conditions.
     """
 
     source = "http://www.colombos.net/cws_data/compendium_data"
     zipfname = "%s_compendium_data.zip" %(organism)
+    mirror_dir = mirror_dir if mirror_dir is not None else os.environ.get("COLOMBOS_MIRROR")
 
-    # Download data if necessary.
     if not os.path.exists(data_dir):
         os.makedirs(data_dir)
-    if not os.path.isfile(data_dir + "/%s" %(zipfname)):
+
+    if mirror_dir is not None:
+        zippath = mirror_dir + "/%s" %(zipfname)
+        if not os.path.isfile(zippath):
+            raise IOError("%s is not in the mirror %s" %(zipfname, mirror_dir))
+        if not os.path.isfile(zippath + ".sha256"):
+            raise IOError("%s has no %s.sha256 to check it against" %(zippath, zippath))
+    else:
+        zippath = data_dir + "/%s" %(zipfname)
+
+    # Download data if necessary.
+    if not os.path.isfile(zippath):
+        if offline:
+            raise IOError("%s is not there and we are offline" %(zippath))
         print("Downloading %s data..." %(organism))
-        urllib.urlretrieve("%s/%s" %(source, zipfname), data_dir + "/%s" %(zipfname))
-
-        # Extract data.
-        fh = zipfile.ZipFile(data_dir + "/%s" %(zipfname))
-        fh.extractall(data_dir)
-        fh.close()
-
-    # Prepare data for later processing.
-    print("Preparing %s data..." %(organism))
-    expfname = glob.glob(data_dir + "/colombos_%s_exprdata_*.txt" %(organism))[0]
-    refannotfname = glob.glob(data_dir + "/colombos_%s_refannot_*.txt" %(organism))[0]
-    testannotfname = glob.glob(data_dir + "/colombos_%s_testannot_*.txt" 
-                               %(organism))[0]
-        
-    df = pandas.read_table(expfname, skiprows = 5, header = 1)
-    df = df.fillna(0.0)
-    genes = df["Gene name"].values
-    expressions = df.iloc[:, 3:len(df.columns)].values
-    contrasts = numpy.array(open(expfname, 
-                                 "r").readline().strip().split('\t')[1:], 
-                            dtype = object)
-    lines = open(refannotfname, "r").readlines()
-    refannot = {}
-    for line in lines[1:]:
-        contrast, annot = line.strip().split("\t")
-        refannot.setdefault(contrast, set())
-        refannot[contrast].add(annot)
-    lines = open(testannotfname, "r").readlines()
-    testannot = {}
-    for line in lines[1:]:
-        contrast, annot = line.strip().split("\t")
-        testannot.setdefault(contrast, set())
-        testannot[contrast].add(annot)
-
-    # Transpose and standardize expressions.
-    expressions = expressions.T
-    expressions_mean = numpy.mean(expressions, axis = 0)
-    expressions_std = numpy.std(expressions, axis = 0)
-    expressions = (expressions - expressions_mean) / expressions_std
-    expressions = numpy.nan_to_num(expressions)
-
-    # Remove extracted files.
-#    os.remove(expfname)
-#    os.remove(refannotfname)
-#    os.remove(testannotfname)
+        tmppath, _ = urllib.urlretrieve("%s/%s" %(source, zipfname))
+        shutil.move(tmppath, zippath)
+
+    digest = sha256sum(zippath)
+    if os.path.isfile(zippath + ".sha256"):
+        with open(zippath + ".sha256", "r") as f:
+            expected = f.read().split()[0]
+        if digest != expected.lower():
+            raise IOError("The checksum of %s doesn't match %s.sha256" %(zippath, zippath))
+    else:
+        logging.warning("There is no %s.sha256, %s is not verified." %(zippath, zippath))
+
+    cache_dir = data_dir + "/%s_cache_%s" %(organism, digest[:16])
+    if not os.path.isdir(cache_dir):
+
+        # Prepare data for later processing.
+        print("Preparing %s data..." %(organism))
+        fh = zipfile.ZipFile(zippath)
+        members = []
+        try:
+            for kind in ["exprdata", "refannot", "testannot"]:
+                pattern = "colombos_%s_%s_*.txt" %(organism, kind)
+                matches = [name for name in fh.namelist() if fnmatch.fnmatch(os.path.basename(name), pattern)]
+                if not matches:
+                    raise IOError("No %s in %s" %(pattern, zippath))
+                members.append(fh.open(matches[0]))
+            convert(members[0], members[1], members[2], cache_dir)
+        finally:
+            for member in members:
+                member.close()
+            fh.close()
+
+    expressions, contrasts, genes, refannot, testannot = load_cache(cache_dir)
+
+    # The cached expressions are standardized with their own statistics.
+    if stats_file is not None and os.path.isfile(stats_file):
+        cache_stats = RunningStats.load(cache_dir + "/stats.npz")
+        expressions = numpy.array(expressions)
+        expressions *= cache_stats.std.astype(expressions.dtype)
+        expressions += cache_stats.mean.astype(expressions.dtype)
+        RunningStats.load(stats_file).standardize(expressions)
+    elif stats_file is not None:
+        shutil.copyfile(cache_dir + "/stats.npz", stats_file)
 
     if shared:
         import theano
@@ -86,6 +123,201 @@ def load(organism, shared = True, data_dir="data/colombos_data"):
                              contrasts, genes, refannot, testannot
     return expressions, contrasts, genes, refannot, testannot
 
+def convert(expfile, refannotfile, testannotfile, cache_dir, chunk_size = 1024):
+    """
+    Converts the Colombos text files of one organism to the binary cache
+    read by load_cache:
+      expressions.npy - the standardized M by N expressions, float32.
+      stats.npz       - the per-gene statistics used to standardize them.
+      contrasts.npy, genes.npy - the contrast and gene names.
+      refannot_*, testannot_* - the AnnotationIndex of the annotations.
+
+    The expression file is read chunk_size genes at a time, so the whole
+    text matrix is never in memory. The cache directory only appears when
+    the conversion is complete. If another conversion created it first,
+    that one is kept.
+
+    :param expfile, refannotfile, testannotfile: open file objects of the
+        exprdata, refannot and testannot text files.
+    """
+
+    parent_dir = os.path.dirname(os.path.abspath(cache_dir))
+    tmp_dir = tempfile.mkdtemp(dir = parent_dir)
+    try:
+        # The genes are rows of the text file, but columns of the cache.
+        # First write them as they come, then transpose by blocks.
+        contrasts = expfile.readline().strip().split('\t')[1:]
+        genes = []
+        nb_columns = None
+        with open(tmp_dir + "/raw", "wb") as raw:
+            for df in pandas.read_table(expfile, skiprows = 4, header = 1, chunksize = chunk_size):
+                df = df.fillna(0.0)
+                genes.append(df["Gene name"].values.astype(str))
+                values = numpy.asarray(df.iloc[:, 3:len(df.columns)].values, dtype = numpy.float32)
+                nb_columns = values.shape[1]
+                values.tofile(raw)
+        genes = numpy.concatenate(genes)
+
+        raw = numpy.memmap(tmp_dir + "/raw", dtype = numpy.float32, mode = "r", shape = (len(genes), nb_columns))
+        expressions = numpy.lib.format.open_memmap(tmp_dir + "/expressions.npy", mode = "w+",
+                                                   dtype = numpy.float32, shape = (nb_columns, len(genes)))
+        for start in range(0, nb_columns, 256):
+            expressions[start:start + 256] = raw[:, start:start + 256].T
+        del raw
+        os.remove(tmp_dir + "/raw")
+
+        # Standardize expressions, in place and by chunks.
+        stats = RunningStats().fit(expressions)
+        stats.save(tmp_dir + "/stats.npz")
+        stats.standardize(expressions)
+        expressions.flush()
+        del expressions
+
+        numpy.save(tmp_dir + "/contrasts.npy", numpy.array(contrasts, dtype = str))
+        numpy.save(tmp_dir + "/genes.npy", genes)
+        for name, annotfile in [("refannot", refannotfile), ("testannot", testannotfile)]:
+            annotfile.readline()
+            pairs = [line.strip().split("\t") for line in annotfile]
+            pairs = numpy.array(pairs, dtype = str).reshape(-1, 2).T
+            AnnotationIndex.from_pairs(contrasts, pairs).save(tmp_dir + "/%s" %(name))
+
+        try:
+            os.rename(tmp_dir, cache_dir)
+        except OSError:
+            # Somebody else converted it first, we use theirs.
+            if not os.path.isdir(cache_dir):
+                raise
+    finally:
+        # Gone if the rename worked, else a failed or duplicate conversion.
+        if os.path.isdir(tmp_dir):
+            shutil.rmtree(tmp_dir)
+
+class AnnotationIndex(object):
+    """
+    Condition annotations of the contrasts, as a sparse contrast by condition
+    incidence matrix. The condition names are interned in a sorted vocabulary.
+
+    The first rows are the contrasts of the expression matrix, in the same
+    order, so the incidence can be used as a label matrix directly. The
+    contrasts only seen in the annotations come after them.
+
+    Also behaves like the old dictionary mapping a contrast to its set of
+    conditions (only the annotated contrasts are keys).
+    """
+
+    def __init__(self, contrasts, conditions, incidence):
+        """
+        :param contrasts: names of the rows.
+        :param conditions: the sorted condition vocabulary, names of the columns.
+        :param incidence: boolean CSR matrix, contrasts by conditions.
+        """
+        self.contrasts = contrasts
+        self.conditions = conditions
+        self.incidence = incidence.tocsr()
+        self.contrasts_order = numpy.argsort(contrasts, kind = "mergesort")
+        self.sorted_contrasts = numpy.asarray(contrasts)[self.contrasts_order]
+        self.by_condition = self.incidence.tocsc()
+
+    @classmethod
+    def from_pairs(cls, contrasts, pairs):
+        """
+        :param contrasts: the contrasts of the expression matrix.
+        :param pairs: 2 by K array of (contrast, condition).
+        """
+        contrasts = numpy.asarray(contrasts, dtype = str)
+        contrasts = numpy.concatenate([contrasts, numpy.setdiff1d(pairs[0], contrasts)])
+        conditions, cols = numpy.unique(pairs[1], return_inverse = True)
+
+        order = numpy.argsort(contrasts, kind = "mergesort")
+        rows = order[numpy.searchsorted(contrasts[order], pairs[0])]
+        incidence = scipy.sparse.csr_matrix((numpy.ones(len(rows), dtype = bool), (rows, cols)),
+                                            shape = (len(contrasts), len(conditions)))
+        incidence.sum_duplicates()
+        return cls(contrasts, conditions, incidence)
+
+    def save(self, prefix):
+        scipy.sparse.save_npz(prefix + "_incidence.npz", self.incidence)
+        numpy.save(prefix + "_contrasts.npy", self.contrasts)
+        numpy.save(prefix + "_conditions.npy", self.conditions)
+
+    @classmethod
+    def load(cls, prefix):
+        return cls(numpy.load(prefix + "_contrasts.npy"), numpy.load(prefix + "_conditions.npy"),
+                   scipy.sparse.load_npz(prefix + "_incidence.npz"))
+
+    def condition_ids(self, conditions):
+        """Columns of the conditions, -1 for the unknown ones."""
+        conditions = numpy.atleast_1d(numpy.asarray(conditions, dtype = str))
+        if len(self.conditions) == 0:
+            return -numpy.ones(len(conditions), dtype = int)
+        ids = numpy.searchsorted(self.conditions, conditions)
+        ids[ids == len(self.conditions)] = 0
+        ids[self.conditions[ids] != conditions] = -1
+        return ids
+
+    def contrasts_with(self, conditions):
+        """
+        Rows of the contrasts annotated with any of the conditions (a name or a
+        list of names), sorted.
+        """
+        ids = self.condition_ids(conditions)
+        ids = ids[ids >= 0]
+        starts, ends = self.by_condition.indptr[ids], self.by_condition.indptr[ids + 1]
+        rows = [self.by_condition.indices[start:end] for start, end in zip(starts, ends)]
+        return numpy.unique(numpy.concatenate(rows + [numpy.array([], dtype = int)]))
+
+    def row(self, contrast):
+        position = numpy.searchsorted(self.sorted_contrasts, contrast)
+        if position == len(self.sorted_contrasts) or self.sorted_contrasts[position] != contrast:
+            return None
+        return self.contrasts_order[position]
+
+    def __getitem__(self, contrast):
+        row = self.row(contrast)
+        if row is None or self.incidence.indptr[row] == self.incidence.indptr[row + 1]:
+            raise KeyError(contrast)
+        columns = self.incidence.indices[self.incidence.indptr[row]:self.incidence.indptr[row + 1]]
+        return set(self.conditions[columns])
+
+    def __contains__(self, contrast):
+        row = self.row(contrast)
+        return row is not None and self.incidence.indptr[row] != self.incidence.indptr[row + 1]
+
+    def keys(self):
+        return list(self.contrasts[numpy.diff(self.incidence.indptr) > 0])
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return int((numpy.diff(self.incidence.indptr) > 0).sum())
+
+    def get(self, contrast, default = None):
+        return self[contrast] if contrast in self else default
+
+def sha256sum(path, chunk_size = 2**20):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), ""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def load_cache(cache_dir):
+    """
+    Opens the binary cache written by convert.
+    Returns the same as load, with the expressions memory-mapped.
+    """
+
+    expressions = numpy.load(cache_dir + "/expressions.npy", mmap_mode = "r")
+    contrasts = numpy.load(cache_dir + "/contrasts.npy").astype(object)
+    genes = numpy.load(cache_dir + "/genes.npy").astype(object)
+
+    annotations = []
+    for name in ["refannot", "testannot"]:
+        annotations.append(AnnotationIndex.load(cache_dir + "/%s" %(name)))
+
+    return expressions, contrasts, genes, annotations[0], annotations[1]
+
 def ecoli(shared):
     """ Escherichia coli (4077 x 4321). """
 
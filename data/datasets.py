@@ -1,11 +1,20 @@
+import os
+import logging
 import numpy as np
 from torch.utils.data import Dataset
+from torch.utils.data.dataloader import default_collate
 import graph
 from graph import Graph
+from stats import RunningStats
 
 
 class Dataset(Dataset):
-    def __init__(self, name, seed, nb_class, nb_examples, nb_nodes, nb_master_nodes=0):
+    def __init__(self, name, seed, nb_class, nb_examples, nb_nodes, nb_master_nodes=0, stats_file=None):
+        """
+        Args:
+            stats_file (string): Where to keep the column statistics used to center the data. If the file
+                already exists (e.g. fitted on the training data) they are loaded instead of computed.
+        """
 
         self.name = name
         self.seed = seed
@@ -13,8 +22,27 @@ class Dataset(Dataset):
         self.nb_examples = nb_examples
         self.nb_nodes = nb_nodes
         self.load_data()
-        self.df = self.df - self.df.mean(0)
         self.nb_master_nodes = nb_master_nodes
+        lazy = getattr(self, 'lazy', False)
+
+        if stats_file is not None and os.path.isfile(stats_file):
+            logging.info("Loading the column statistics from {}".format(stats_file))
+            self.stats = RunningStats.load(stats_file)
+            if len(self.stats.mean) != self.data.shape[1]:
+                raise ValueError("{} has the statistics of {} columns, but the data has {}.".format(
+                    stats_file, len(self.stats.mean), self.data.shape[1]))
+        else:
+            self.stats = self.data.stats if lazy else RunningStats().fit(self.df.values)
+            if stats_file is not None:
+                self.stats.save(stats_file)
+
+        if lazy:
+            # The rows are centered when they are read.
+            self.data.mean = self.stats.mean
+            self.data.add_master_nodes(nb_master_nodes)
+            return
+
+        self.df = self.df - self.stats.mean
 
         for master in range(nb_master_nodes):
             self.df.insert(0, 'master_{}'.format(master), 1.)
@@ -31,6 +59,13 @@ class Dataset(Dataset):
     def __getitem__(self, idx):
         raise NotImplementedError()
 
+    def get_batch(self, idx):
+        """
+        Returns the examples `idx` already collated, as a DataLoader would.
+        Datasets can override it with a vectorized version, see data.utils.BatchLoader.
+        """
+        return default_collate([self[i] for i in idx])
+
     def __len__(self):
         return self.data.shape[0]
 
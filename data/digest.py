@@ -0,0 +1,49 @@
+import hashlib
+import numpy as np
+import scipy.sparse
+
+
+def hash_adj(adj, *args, **kwargs):
+
+    """
+    A digest of the adj matrix (and of some extra parameters) that is stable across runs.
+    The raw buffer is hashed in chunks of rows, with its dtype and shape, so we never copy or print the whole matrix.
+    :param adj: The adj matrix, dense or sparse.
+    :param args: Anything else that goes in the key. Needs a stable str().
+    :param chunk_size: The number of bytes we hash at a time.
+    :return: An hexadecimal string.
+    """
+
+    chunk_size = kwargs.get('chunk_size', 2 ** 24)
+
+    digest = hashlib.md5()
+    if scipy.sparse.issparse(adj):
+        adj = adj.tocsr()
+        arrays = [adj.data, adj.indices, adj.indptr]
+        digest.update('sparse' + str(adj.shape))
+    else:
+        arrays = [np.asarray(adj)]
+
+    for array in arrays:
+        digest.update(array.dtype.str + str(array.shape))
+
+        array = array.reshape((array.shape[0], -1)) if array.ndim > 1 else array.reshape((-1, 1))
+        nb_rows = max(1, chunk_size // max(1, array[:1].nbytes))
+        for start in range(0, array.shape[0], nb_rows):
+            digest.update(np.ascontiguousarray(array[start:start + nb_rows]))
+
+    digest.update(str(args))
+    return digest.hexdigest()
+
+
+def data_digest(data, chunk_size=1024, nb_rows=None):
+    """
+    hash_adj of a data matrix, `chunk_size` rows at a time, so a LazyExpression (or an HDF5 dataset) is never read
+    all at once.
+    :param nb_rows: Only the first rows. None for all of them.
+    """
+    nb_rows = data.shape[0] if nb_rows is None else min(nb_rows, data.shape[0])
+    digest = hashlib.md5(str((nb_rows,) + tuple(data.shape[1:])))
+    for start in range(0, nb_rows, chunk_size):
+        digest.update(hash_adj(np.asarray(data[start:min(start + chunk_size, nb_rows)])))
+    return digest.hexdigest()
@@ -1,34 +1,146 @@
 import os
 import h5py
+import torch
 import pandas as pd
 import collections
 import logging
+import hashlib
+import tempfile
 import numpy as np
 from datasets import Dataset
+from stats import RunningStats
+from digest import data_digest
+from propagation import load_propagated
+
+
+class LazyExpression(object):
+    """
+    Mean-centered rows of an expression matrix, read on demand.
+
+    Stands in for the in-memory data matrix of a lazy GeneDataset: it supports `shape`, `len`, indexing of
+    rows and selecting columns, and only the rows asked for are read from the HDF5 dataset (or memory-mapped array).
+    The column means are computed once, in a streaming pass of `chunk_size` rows.
+    """
+
+    def __init__(self, source, nb_examples=None, chunk_size=1024):
+        """
+        Args:
+            source: h5py dataset or numpy (memory-mapped) array of shape (examples, genes).
+            nb_examples (int): Only use the first `nb_examples` rows.
+            chunk_size (int): Number of rows read at once when computing the means.
+        """
+
+        self.source = source
+        nb_rows = source.shape[0] if nb_examples is None else min(nb_examples, source.shape[0])
+        self.rows = np.arange(nb_rows)
+        self.nb_master_nodes = 0
+        self.columns = None  # All of them.
+        self.chunk_size = chunk_size
+        self.stats = self.compute_stats()
+        self.mean = self.stats.mean
+
+    def compute_stats(self):
+        stats = RunningStats()
+        for start in range(0, len(self.rows), self.chunk_size):
+            stats.update(self.read(self.rows[start:start + self.chunk_size]))
+        return stats
+
+    def read(self, rows):
+        """Reads some rows of the source, as is."""
+        if np.ndim(rows) == 0:
+            return np.asarray(self.source[int(rows)])
+        if len(rows) and np.all(np.diff(rows) == 1):
+            return np.asarray(self.source[rows[0]:rows[-1] + 1])
+
+        # h5py wants increasing and unique indices.
+        unique, inverse = np.unique(rows, return_inverse=True)
+        return np.asarray(self.source[unique.tolist()])[inverse]
+
+    @property
+    def shape(self):
+        nb_columns = self.source.shape[1] + self.nb_master_nodes
+        return (len(self.rows), nb_columns if self.columns is None else len(self.columns))
+
+    @property
+    def dtype(self):
+        return self.source.dtype
+
+    def __len__(self):
+        return len(self.rows)
+
+    def add_master_nodes(self, nb_master_nodes):
+        # Same as the 'master_{i}' columns inserted by Dataset: constant 1. in front of the genes.
+        self.nb_master_nodes += nb_master_nodes
+
+    def subset(self, rows):
+        """Returns a view on some of the rows, centered with their own column means."""
+        view = LazyExpression.__new__(LazyExpression)
+        view.__dict__.update(self.__dict__)
+        view.rows = self.rows[rows]
+        view.stats = view.compute_stats()
+        view.mean = view.stats.mean
+        return view
+
+    def select_columns(self, columns):
+        """Returns a view on some of the columns (master nodes included), as data[:, columns] would."""
+        view = LazyExpression.__new__(LazyExpression)
+        view.__dict__.update(self.__dict__)
+        view.columns = np.arange(self.shape[1])[columns]
+        if self.columns is not None:
+            view.columns = self.columns[view.columns]
+        return view
+
+    def __getitem__(self, idx):
+        data = self.read(self.rows[idx])
+        data = (data - self.mean).astype(data.dtype)
+        if self.nb_master_nodes:
+            masters = np.ones(data.shape[:-1] + (self.nb_master_nodes,), dtype=data.dtype)
+            data = np.concatenate([masters, data], axis=-1)
+        if self.columns is not None:
+            data = data[..., self.columns]
+        return data
 
 
 class GeneDataset(Dataset):
     """Gene Expression Dataset."""
 
-    def __init__(self, data_dir=None, data_file=None, sub_class=None, name=None, seed=None, nb_class=None, nb_examples=None, nb_nodes=None, **kwargs):
+    def __init__(self, data_dir=None, data_file=None, sub_class=None, name=None, seed=None, nb_class=None, nb_examples=None, nb_nodes=None,
+                 propagated_file=None, lazy=False, **kwargs):
         """
         Args:
             data_file (string): Path to the h5df file.
+            propagated_file (string): Path to the A^k X features precomputed with data.propagation.propagate_expression.
+                If given, they are used instead of the 'expression_data'.
+            lazy (bool): Keep the data on disk and read (and center) the rows when they are asked for,
+                instead of loading everything in memory. See LazyExpression. There is no `df` in that case.
         """
 
         self.sub_class = sub_class
         self.data_dir = data_dir
         self.data_file = data_file
+        self.propagated_file = propagated_file
+        self.lazy = lazy
 
         super(GeneDataset, self).__init__(name=name, seed=seed, nb_class=nb_class, nb_examples=nb_examples, nb_nodes=nb_nodes, **kwargs)
 
     def load_data(self):
         data_file = os.path.join(self.data_dir, self.data_file)
         self.file = h5py.File(data_file, 'r')
-        self.data = np.array(self.file['expression_data'][:self.nb_examples])
+        if self.propagated_file is not None:
+            logging.info("Using the propagated features in {}".format(self.propagated_file))
+            expression = load_propagated(self.propagated_file, self.file, self.nb_examples)
+        else:
+            expression = self.file['expression_data']
+
+        if self.lazy:
+            self.data = LazyExpression(expression, nb_examples=self.nb_examples)
+        elif self.propagated_file is not None:
+            self.data = expression[:self.nb_examples]
+        else:
+            self.data = np.array(expression[:self.nb_examples])
         self.nb_nodes = self.data.shape[1]
         try:
-            self.labels = self.file['labels_data']
+            self.labels = np.array(self.file['labels_data'])
         except Exception:
             self.labels = np.array([])
         try:
@@ -36,11 +148,14 @@ class GeneDataset(Dataset):
         except Exception:
             self.sample_names = pd.DataFrame([])
         self.node_names = np.array(self.file['gene_names'])
-        self.df = pd.DataFrame(self.data)
-
-        self.df.columns = self.node_names[:len(self.df.columns)]
+        nb_columns = self.data.shape[1]
+        if self.lazy:
+            self.df = None
+        else:
+            self.df = pd.DataFrame(self.data)
+            self.df.columns = self.node_names[:nb_columns]
         self.nb_class = self.nb_class if self.nb_class is not None else 2
-        self.label_name = self.node_names[len(self.df.columns)+1:]
+        self.label_name = self.node_names[nb_columns+1:]
         self.transform = None
 
         if self.labels.shape != self.labels[:].reshape(-1).shape:
@@ -49,7 +164,10 @@ class GeneDataset(Dataset):
 
         # Take a number of subclasses
         if self.sub_class is not None:
-            self.data = self.data[[i in self.sub_class for i in self.labels]]
+            if self.lazy:
+                self.data = self.data.subset(np.where([i in self.sub_class for i in self.labels])[0])
+            else:
+                self.data = self.data[[i in self.sub_class for i in self.labels]]
             self.labels = self.labels[[i in self.sub_class for i in self.labels]]
             self.nb_class = len(self.sub_class)
             for i, c in enumerate(np.sort(self.sub_class)):
@@ -62,6 +180,12 @@ class GeneDataset(Dataset):
         sample = {'sample': sample, 'labels': label}
         return sample
 
+    def get_batch(self, idx):
+        idx = np.asarray(idx)
+        sample = np.asarray(self.data[idx])[:, :, np.newaxis]
+        label = np.asarray(self.labels[idx])
+        return {'sample': torch.from_numpy(sample), 'labels': torch.from_numpy(label)}
+
     def labels_name(self, l):
         if type(self.label_name[str(l)]) == np.ndarray:
             return self.label_name[str(l)][0]
@@ -75,7 +199,13 @@ class TCGATissue(GeneDataset):
 
 class TCGAGeneInference(GeneDataset):
     """TCGA Dataset. We predict tissue."""
-    def __init__(self, data_dir='/data/lisa/data/genomics/TCGA/', data_file='TCGA_tissue_ppi.hdf5', **kwargs):
+    def __init__(self, data_dir='/data/lisa/data/genomics/TCGA/', data_file='TCGA_tissue_ppi.hdf5', precompute=False,
+                 precomputed_dir=None, **kwargs):
+        """
+        Args:
+            precompute (bool): Build the masked inputs and targets once, on the first access. See precomputed_arrays.
+            precomputed_dir (string): Keep them in memory-mapped files in this directory instead of in memory.
+        """
         super(TCGAGeneInference, self).__init__(data_dir=data_dir, data_file=data_file, name='TCGATissue', **kwargs)
 
 
@@ -86,29 +216,54 @@ class TCGAGeneInference(GeneDataset):
         # Do something not stupid here.
         self.gene_to_keep = all_genes[:total_gene/2]
         self.gene_to_infer = all_genes[total_gene/2:total_gene]
-        self.df = self.df.iloc[:, :total_gene]
-        self.data = self.data[:, :total_gene]
+        if self.lazy:
+            self.data = self.data.select_columns(slice(None, total_gene))
+            masters = ['master_{}'.format(master) for master in reversed(range(self.nb_master_nodes))]
+            self.node_names = pd.Index(masters + list(self.node_names))[:total_gene]
+        else:
+            self.df = self.df.iloc[:, :total_gene]
+            self.data = self.data[:, :total_gene]
+            self.node_names = self.df.columns
         self.nb_nodes = total_gene
-        self.node_names = self.df.columns
+
+        self.precompute = precompute
+        self.precomputed_dir = precomputed_dir
+        self.precomputed = None
 
 
     def __getitem__(self, idx):
-        sample = self.data[idx]
+        precomputed = precomputed_arrays(self)
+        if precomputed is not None:
+            inputs, targets = precomputed
+            return {'sample': inputs[idx], 'labels': targets[idx]}
+
+        sample = self.data[idx].copy()
         sample[self.gene_to_infer] = 0.
         sample[self.gene_to_keep] += 1e-8
 
         sample = np.expand_dims(sample, axis=-1)
 
-        label = self.data[idx]
+        label = self.data[idx].copy()
         label[self.gene_to_keep] = 0.
         label[self.gene_to_infer] += 1e-8
 
         sample = {'sample': sample, 'labels': label}
         return sample
 
+    def get_batch(self, idx):
+        if precomputed_arrays(self) is not None:
+            return precomputed_batch(self, idx)
+        return masked_batch(self.data[np.asarray(idx)], self.gene_to_keep, self.gene_to_infer)
+
 
 class DGEXGEO(GeneDataset):
-    def __init__(self, data_dir='/data/lisa/data/genomics/D-GEX/', data_file='bgedv2.hdf5', **kwargs):
+    def __init__(self, data_dir='/data/lisa/data/genomics/D-GEX/', data_file='bgedv2.hdf5', precompute=False,
+                 precomputed_dir=None, **kwargs):
+        """
+        Args:
+            precompute (bool): Build the masked inputs and targets once, on the first access. See precomputed_arrays.
+            precomputed_dir (string): Keep them in memory-mapped files in this directory instead of in memory.
+        """
         super(DGEXGEO, self).__init__(data_dir=data_dir, data_file=data_file, name='GDEXGEO', **kwargs)
     	lm_gene_num = 943 + self.nb_master_nodes
         self.all_gene_num = 10018 + self.nb_master_nodes
@@ -117,11 +272,19 @@ class DGEXGEO(GeneDataset):
         self.gene_to_keep = all_genes[:lm_gene_num]
     	self.gene_to_infer = all_genes[lm_gene_num:]
 
+        self.precompute = precompute
+        self.precomputed_dir = precomputed_dir
+        self.precomputed = None
 
 
     def __getitem__(self, idx):
         assert self.data.shape[1] == self.all_gene_num
 
+        precomputed = precomputed_arrays(self)
+        if precomputed is not None:
+            inputs, targets = precomputed
+            return {'sample': inputs[idx], 'labels': targets[idx]}
+
         #import ipdb; ipdb.set_trace()
 
         sample = self.data[idx].copy()
@@ -139,6 +302,103 @@ class DGEXGEO(GeneDataset):
 
         return sample
 
+    def get_batch(self, idx):
+        assert self.data.shape[1] == self.all_gene_num
+        if precomputed_arrays(self) is not None:
+            return precomputed_batch(self, idx)
+        return masked_batch(self.data[np.asarray(idx)], self.gene_to_keep, self.gene_to_infer)
+
+
+def mask_genes(data, gene_to_keep, gene_to_infer):
+    """
+    The gene inference split of some rows: the input only has the genes to keep, the target only the genes to infer.
+    :param data: a copy of the rows, (examples, genes). It is used for the target.
+    :return: the input and the target, both (examples, genes)
+    """
+    sample = data.copy()
+    sample[:, gene_to_infer] = 0.
+    sample[:, gene_to_keep] += 1e-8
+
+    label = data
+    label[:, gene_to_keep] = 0.
+    label[:, gene_to_infer] += 1e-8
+    return sample, label
+
+
+def masked_batch(data, gene_to_keep, gene_to_infer):
+    """Batched version of the gene inference __getitem__. See mask_genes."""
+    sample, label = mask_genes(data, gene_to_keep, gene_to_infer)
+    return {'sample': torch.from_numpy(sample[:, :, np.newaxis]), 'labels': torch.from_numpy(label)}
+
+
+def precomputed_batch(dataset, idx):
+    idx = np.asarray(idx)
+    inputs, targets = precomputed_arrays(dataset)
+    return {'sample': torch.from_numpy(np.asarray(inputs[idx])),
+            'labels': torch.from_numpy(np.asarray(targets[idx]))}
+
+
+def precomputed_arrays(dataset):
+    """
+    The precomputed inputs and targets of a gene inference dataset, or None if it doesn't precompute them.
+    They are built on the first access, and again whenever `dataset.data` is replaced
+    (e.g. by Graph.intersection_with or add_noise), so they always follow the current data.
+    """
+    if not dataset.precompute and dataset.precomputed_dir is None:
+        return None
+    if dataset.precomputed is None or dataset.precomputed[0] is not dataset.data:
+        dataset.precomputed = (dataset.data, precompute_inference(dataset, dataset.precomputed_dir))
+    return dataset.precomputed[1]
+
+
+def precompute_inference(dataset, processed_dir=None, chunk_size=1024):
+    """
+    Materializes the gene inference inputs (examples, genes, 1) and targets (examples, genes) of a dataset once,
+    so getting an example is only a view on them.
+    If processed_dir is given, they are memory-mapped .npy files there, reused as long as the data file, the
+    content of the data and the genes to keep/infer are the same.
+    :return: the inputs and the targets
+    """
+
+    shape = dataset.data.shape
+    if processed_dir is None:
+        inputs = np.empty(shape + (1,), dtype=dataset.data.dtype)
+        targets = np.empty(shape, dtype=dataset.data.dtype)
+    else:
+        key = hashlib.md5()
+        key.update(str((dataset.data_file, getattr(dataset, 'propagated_file', None))))
+        key.update(data_digest(dataset.data))
+        for array in [dataset.gene_to_keep, dataset.gene_to_infer]:
+            key.update(np.ascontiguousarray(array).tobytes())
+        prefix = os.path.join(processed_dir, '{}-{}'.format(dataset.name, key.hexdigest()))
+        inputs_file, targets_file = prefix + '-inputs.npy', prefix + '-targets.npy'
+
+        if os.path.isfile(inputs_file) and os.path.isfile(targets_file):
+            logging.info("Loading the precomputed inputs and targets from {}".format(prefix))
+            return np.load(inputs_file, mmap_mode='r'), np.load(targets_file, mmap_mode='r')
+
+        if not os.path.exists(processed_dir):
+            os.makedirs(processed_dir)
+        tmp_files = [tempfile.NamedTemporaryFile(dir=processed_dir, suffix='.npy', delete=False).name for _ in range(2)]
+        inputs = np.lib.format.open_memmap(tmp_files[0], mode='w+', dtype=dataset.data.dtype, shape=shape + (1,))
+        targets = np.lib.format.open_memmap(tmp_files[1], mode='w+', dtype=dataset.data.dtype, shape=shape)
+
+    logging.info("Precomputing the inputs and targets of {} examples...".format(shape[0]))
+    for start in range(0, shape[0], chunk_size):
+        chunk = np.array(dataset.data[start:start + chunk_size])
+        sample, label = mask_genes(chunk, dataset.gene_to_keep, dataset.gene_to_infer)
+        inputs[start:start + chunk_size, :, 0] = sample
+        targets[start:start + chunk_size] = label
+
+    if processed_dir is None:
+        return inputs, targets
+
+    # Only rename when complete, so a crash doesn't leave a half written cache behind.
+    del inputs, targets
+    os.rename(tmp_files[0], inputs_file)
+    os.rename(tmp_files[1], targets_file)
+    return np.load(inputs_file, mmap_mode='r'), np.load(targets_file, mmap_mode='r')
+
 
 class TCGAForLabel(GeneDataset):
     """TCGA Dataset."""
@@ -148,6 +408,8 @@ class TCGAForLabel(GeneDataset):
                  clinical_file="PANCAN_clinicalMatrix.gz",
                  clinical_label="gender",
                  **kwargs):
+        if kwargs.get('lazy'):
+            raise ValueError("TCGAForLabel joins the whole data with the clinical labels, it can't be lazy.")
         super(TCGAForLabel, self).__init__(data_dir=data_dir, data_file=data_file, name='TCGAForLabel', **kwargs)
 
         dataset = self
@@ -1,4 +1,5 @@
 import numpy as np
+import scipy.sparse
 import h5py
 import percolate
 import random
@@ -12,32 +13,59 @@ class Graph(object):
     def __init__(self):
         pass
 
-    def intersection_with(self, dataset):
-        # Drop duplicate columns in dataset.def
-
+    def set_node_names(self, node_names):
+        """Sets the names of the nodes and the name -> row (and column) of the adj map, self.node_index."""
+        self.node_names = node_names
+        names = pd.Index(node_names)
+        first = ~names.duplicated()  # the first node wins if some names are there twice
+        self.node_index = pd.Series(np.where(first)[0], index=names[first])
 
-        l = dataset.df.columns.tolist()
-        duplicates = set([x for x in l if l.count(x) > 1])
-        for dup in duplicates:
-            l.remove(dup)
-        dataset.df = dataset.df.groupby(lambda x:x, axis=1).mean()
-        dataset.df = dataset.df[l]
+    def intersection_with(self, dataset):
+        """
+        Aligns the graph and the dataset on the genes of the dataset.
+
+        The duplicate gene columns of the dataset are averaged (and kept at their last position). The graph
+        becomes a sparse adj over those genes, in the same order, with no edges for the genes it doesn't have.
+        Names are matched by hashing, so nothing is quadratic in the number of genes and no dense
+        N x N DataFrame is built.
+        """
+
+        if dataset.df is None:
+            raise ValueError("intersection_with averages and reorders the genes of the dataset in memory, "
+                             "it doesn't work with a lazy dataset.")
+
+        # Drop duplicate columns in dataset, averaging them.
+        codes, uniques = pd.factorize(dataset.df.columns)
+        counts = np.bincount(codes)
+        if (counts > 1).any():
+            last = np.zeros(len(uniques), dtype=int)
+            np.maximum.at(last, codes, np.arange(len(codes)))
+            order = np.argsort(last)
+            new_position = np.empty(len(uniques), dtype=int)
+            new_position[order] = np.arange(len(uniques))
+
+            dtype = dataset.df.values.dtype
+            average = scipy.sparse.csr_matrix(((1. / counts[codes]).astype(dtype), (np.arange(len(codes)), new_position[codes])),
+                                              shape=(len(codes), len(uniques)))
+            data = np.asarray(average.T.dot(dataset.df.values.T).T)
+            dataset.df = pd.DataFrame(data, index=dataset.df.index, columns=uniques[order])
         dataset.node_names = dataset.df.columns.tolist()
-        dataset.data = dataset.df.as_matrix()
-
-        # find intersection with graph
-    	intersection = np.intersect1d(self.node_names, dataset.df.columns.tolist())
-
-        # filter rows/columns in graph that aren't in dataset
-        self.df = self.df[intersection].filter(items=intersection, axis='index')
-
-        #add zero'd columns/rows to graph for genes present only in dataset
-    	diff = np.setdiff1d(dataset.node_names, intersection)
-    	zeros = pd.DataFrame(0, index=diff.tolist(), columns=diff.tolist())
-        self.df = pd.concat([self.df, zeros]).fillna(0.)
-        self.df = self.df[l].loc[l]
-
-        self.adj = self.df.as_matrix()
+        dataset.data = dataset.df.values
+
+        # Where each gene of the dataset is in the graph (NaN if it isn't).
+        if not hasattr(self, 'node_index'):
+            self.set_node_names(self.node_names)
+        positions = self.node_index.reindex(dataset.node_names).values
+        found = ~np.isnan(positions)
+        rows = np.where(found)[0]
+
+        # P G P^T, with P selecting (and ordering) the genes of the dataset.
+        adj = scipy.sparse.csr_matrix(self.adj)
+        selection = scipy.sparse.csr_matrix((np.ones(len(rows), dtype=adj.dtype), (rows, positions[found].astype(int))),
+                                            shape=(len(dataset.node_names), adj.shape[0]))
+        self.adj = selection.dot(adj).dot(selection.T).tocsr()
+        self.set_node_names(dataset.node_names)
+        self.df = None  # The graph is only kept as the sparse adj.
 
     def load_random_adjacency(self, nb_nodes, approx_nb_edges, scale_free=True):
         nodes = np.arange(nb_nodes)
@@ -60,15 +88,17 @@ class Graph(object):
         A[edges[:, 1], edges[:, 0]] = 1.
         self.adj = A
         self.df = pd.DataFrame(np.array(self.adj))
-        self.node_names = list(range(nb_nodes))
+        self.set_node_names(list(range(nb_nodes)))
 
     def load_graph(self, path):
-        f = h5py.File(path, 'r')
-        self.adj = np.array(f['graph_data']).astype('float32')
-        self.node_names = np.array(f['gene_names'])
-        self.df = pd.DataFrame(np.array(self.adj))
-        self.df.columns = self.node_names
-        self.df.index = self.node_names
+        """
+        Loads the graph as a sparse (CSR) adj, from either the sparse format (see convert_graph)
+        or the dense 'graph_data' one, which is then read by blocks of rows.
+        """
+        with h5py.File(path, 'r') as f:
+            self.adj = read_adj(f)
+            self.set_node_names(np.array(f['gene_names']))
+        self.df = None  # The graph is only kept as the sparse adj.
 
     def build_correlation_graph(self, dataset, threshold=0.2):
 
@@ -81,17 +111,29 @@ class Graph(object):
 
         self.adj = corr
         self.df = pd.DataFrame(np.array(self.adj))
-        self.node_names = list(range(self.adj.shape[0]))
+        self.set_node_names(list(range(self.adj.shape[0])))
 
 
     def add_master_nodes(self, nb_master_nodes):
+        """
+        Adds master nodes connected to all the nodes (and to each other), in front of them,
+        in the same order as the 'master_{i}' columns of Dataset.
+        """
         if nb_master_nodes > 0:
-            master = pd.DataFrame(1., index=['master_{}'.format(i) for i in range(nb_master_nodes)], columns=['master_{}'.format(i) for i in range(nb_master_nodes)])
-            self.df = pd.concat([self.df, master]).fillna(1,)
-            self.node_names = self.df.columns
-
-
-        self.adj = self.df.as_matrix()
+            nb_nodes = self.adj.shape[0]
+            nb_total = nb_nodes + nb_master_nodes
+            master_names = ['master_{}'.format(i) for i in reversed(range(nb_master_nodes))]
+
+            if scipy.sparse.issparse(self.adj):
+                ones = scipy.sparse.csr_matrix(np.ones((nb_master_nodes, nb_total), dtype=self.adj.dtype))
+                self.adj = scipy.sparse.bmat([[ones[:, :nb_master_nodes], ones[:, nb_master_nodes:]],
+                                              [ones[:, nb_master_nodes:].T, self.adj]]).tocsr()
+            else:
+                adj = np.ones((nb_total, nb_total), dtype=np.asarray(self.adj).dtype)
+                adj[nb_master_nodes:, nb_master_nodes:] = self.adj
+                self.adj = adj
+            self.set_node_names(master_names + list(self.node_names))
+            self.df = None
 
     def generate_percolate(self, opt):
         self.nb_class = 2
@@ -151,10 +193,44 @@ class Graph(object):
         self.adj = adj
         self.data = expression_data
         self.labels = labels_data
-        self.node_names = range(0, self.data.shape[1])
+        self.set_node_names(range(0, self.data.shape[1]))
         self.nb_class = 2
 
 
+def read_adj(f, chunk_size=1024):
+    """
+    Reads the adj of an opened graph file as a float32 CSR matrix.
+    Sparse files have 'graph_indptr', 'graph_indices', 'graph_values' and 'graph_shape'. In the dense 'graph_data'
+    ones, only chunk_size rows at a time are in memory.
+    """
+    if 'graph_indptr' in f:
+        return scipy.sparse.csr_matrix((np.array(f['graph_values']), np.array(f['graph_indices']), np.array(f['graph_indptr'])),
+                                       shape=tuple(np.array(f['graph_shape'])))
+
+    data = f['graph_data']
+    blocks = [scipy.sparse.csr_matrix(np.asarray(data[start:start + chunk_size], dtype=np.float32))
+              for start in range(0, data.shape[0], chunk_size)]
+    return scipy.sparse.vstack(blocks, format='csr', dtype=np.float32)
+
+
+def convert_graph(path, sparse_path, chunk_size=1024):
+    """
+    Converts a dense 'graph_data' graph file to the sparse (CSR) format, read by blocks of chunk_size rows.
+    The gene names are copied as is.
+    """
+    with h5py.File(path, 'r') as f:
+        adj = read_adj(f, chunk_size=chunk_size)
+        gene_names = np.array(f['gene_names'])
+
+    logging.info("The graph has {} nodes and {} edges".format(adj.shape[0], adj.nnz))
+    with h5py.File(sparse_path, 'w') as f:
+        f.create_dataset('graph_indptr', data=adj.indptr.astype(np.int64))
+        f.create_dataset('graph_indices', data=adj.indices.astype(np.int32))
+        f.create_dataset('graph_values', data=adj.data)
+        f.create_dataset('graph_shape', data=np.array(adj.shape, dtype=np.int64))
+        f.create_dataset('gene_names', data=gene_names)
+
+
 def get_path(graph):
     if graph == "kegg":
         return "/data/lisa/data/genomics/graph/kegg.hdf5"
@@ -0,0 +1,108 @@
+import os
+import h5py
+import logging
+import tempfile
+import numpy as np
+import scipy.sparse
+from digest import hash_adj, data_digest
+
+
+def propagate_expression(adj, data_file, processed_file, nb_hops=1, chunk_size=1024, nb_examples=None):
+    """
+    Compute A^k X for the whole expression matrix, once, so the linear propagation models (SGC-like) don't
+    have to do the sparse product at every epoch.
+    The HDF5 'expression_data' is read chunk by chunk, and the result is written in a memory-mapped .npy.
+    Its shape and digests of the source rows, gene names and adj are saved next to it (see source_file),
+    so load_propagated can check it still goes with the data.
+
+    :param adj: The adj matrix used for the propagation (i.e. the output of ApprNormalizeLaplacian), dense or sparse.
+    :param data_file: Path to the h5df file.
+    :param processed_file: Where to save the propagated features (.npy).
+    :param nb_hops: k, how many times we multiply by the adj.
+    :param chunk_size: How many examples we read and propagate at a time.
+    :param nb_examples: Only propagate the first examples. None for all of them.
+    :return: The propagated features, memory-mapped.
+    """
+
+    adj = scipy.sparse.csr_matrix(adj, dtype=np.float32)
+
+    with h5py.File(data_file, 'r') as f:
+        data = f['expression_data']
+        nb_examples = data.shape[0] if nb_examples is None else min(nb_examples, data.shape[0])
+        if data.shape[1] != adj.shape[0]:
+            raise ValueError("The adj has {} nodes, but the data has {} genes.".format(adj.shape[0], data.shape[1]))
+
+        # Write next to the final file first, so nobody reads a half propagated file.
+        processed_dir = os.path.dirname(os.path.abspath(processed_file))
+        if not os.path.exists(processed_dir):
+            os.makedirs(processed_dir)
+        tmp_file = tempfile.NamedTemporaryFile(dir=processed_dir, suffix='.npy', delete=False).name
+        source = describe_source(f, nb_examples)
+        source['adj'] = hash_adj(adj, nb_hops)
+
+        logging.info("Propagating {} examples over {} hops...".format(nb_examples, nb_hops))
+        propagated = np.lib.format.open_memmap(tmp_file, mode='w+', dtype=np.float32, shape=(nb_examples, data.shape[1]))
+        for start in range(0, nb_examples, chunk_size):
+            end = min(start + chunk_size, nb_examples)
+            chunk = np.asarray(data[start:end], dtype=np.float32).T  # node, ex
+
+            for _ in range(nb_hops):
+                chunk = adj.dot(chunk)
+
+            propagated[start:end] = chunk.T
+
+        propagated.flush()
+        del propagated
+
+    # The description first, so the features are never there without it.
+    tmp_source = tempfile.NamedTemporaryFile(dir=processed_dir, suffix='.npz', delete=False).name
+    with open(tmp_source, 'wb') as source_f:
+        np.savez(source_f, **source)
+    os.rename(tmp_source, source_file(processed_file))
+    os.rename(tmp_file, processed_file)
+    logging.info("Done! The propagated features are in {}".format(processed_file))
+
+    return np.load(processed_file, mmap_mode='r')
+
+
+def source_file(processed_file):
+    """Where the description of the source of the propagated features is saved."""
+    return os.path.splitext(processed_file)[0] + '_source.npz'
+
+
+def describe_source(f, nb_examples):
+    """The shape, and digests of the expression rows and gene names, of the first nb_examples of an HDF5 file."""
+    data = f['expression_data']
+    gene_names = np.asarray(f['gene_names']) if 'gene_names' in f else np.array([])
+    return {'shape': np.array([nb_examples, data.shape[1]]),
+            'data': data_digest(data, nb_rows=nb_examples),
+            'gene_names': hash_adj(gene_names)}
+
+
+def load_propagated(processed_file, f, nb_examples=None):
+    """
+    The propagated features of processed_file, memory-mapped, after checking they were computed from
+    the first nb_examples (None for all) of the opened HDF5 file f.
+    Raises a ValueError if they weren't, or if there is nothing to tell (no source file).
+    """
+
+    if not os.path.isfile(source_file(processed_file)):
+        raise ValueError("{} has no {}, we can't check which data it comes from. Run propagate_expression again.".format(
+            processed_file, source_file(processed_file)))
+
+    with np.load(source_file(processed_file)) as saved:
+        saved = dict((key, saved[key]) for key in saved.files)
+    propagated = np.load(processed_file, mmap_mode='r')
+
+    nb_rows = f['expression_data'].shape[0] if nb_examples is None else min(nb_examples, f['expression_data'].shape[0])
+    if propagated.shape[0] < nb_rows or tuple(saved['shape']) != propagated.shape:
+        raise ValueError("{} has {} examples of {} genes, we need {} examples of {} genes.".format(
+            processed_file, propagated.shape[0], propagated.shape[1], nb_rows, f['expression_data'].shape[1]))
+
+    current = describe_source(f, propagated.shape[0])
+    for key in ['shape', 'data', 'gene_names']:
+        if not np.array_equal(current[key], saved[key]):
+            raise ValueError("{} wasn't propagated from this data ({} differ). Run propagate_expression again.".format(
+                processed_file, key))
+
+    return propagated
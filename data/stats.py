@@ -0,0 +1,93 @@
+import numpy as np
+
+
+class RunningStats(object):
+    """
+    Per-column mean and variance of a matrix, accumulated over chunks of rows.
+
+    The chunks are merged with the pairwise (Chan et al.) form of Welford's update, so the whole matrix
+    never has to be in memory and the result does not suffer from the cancellation of sum(x^2) - sum(x)^2.
+    Like pandas, the NaN are skipped: each column has its own count of values, and a column without any
+    value has a NaN mean.
+    The fitted statistics can be saved and reloaded, to normalize new data the same way at inference time.
+    """
+
+    def __init__(self):
+        self.count = None
+        self.mean = None
+        self.m2 = None
+
+    def update(self, chunk):
+        """
+        Adds a chunk of rows to the statistics.
+        :param chunk: array of shape (rows, columns)
+        """
+
+        chunk = np.asarray(chunk, dtype=np.float64)
+        if chunk.shape[0] == 0:
+            return self
+
+        valid = ~np.isnan(chunk)
+        nb_values = valid.sum(axis=0).astype(np.float64)
+        chunk_mean = np.where(valid, chunk, 0.).sum(axis=0) / np.maximum(nb_values, 1)
+        chunk_m2 = np.where(valid, (chunk - chunk_mean) ** 2, 0.).sum(axis=0)
+
+        if self.count is None:
+            self.count, self.mean, self.m2 = np.zeros_like(nb_values), np.zeros_like(chunk_mean), np.zeros_like(chunk_m2)
+        mean = np.where(self.count > 0, self.mean, 0.)
+
+        total = self.count + nb_values
+        delta = chunk_mean - mean
+        self.mean = mean + delta * (nb_values / np.maximum(total, 1))
+        self.m2 = self.m2 + chunk_m2 + delta ** 2 * (self.count * nb_values / np.maximum(total, 1))
+        self.count = total
+        self.mean[self.count == 0] = np.nan
+        return self
+
+    def fit(self, data, chunk_size=256):
+        """
+        Accumulates all the rows of `data`, `chunk_size` at a time.
+        :param data: anything that can be sliced by rows: numpy array, memmap, h5py dataset.
+        """
+
+        for start in range(0, data.shape[0], chunk_size):
+            self.update(data[start:start + chunk_size])
+        return self
+
+    @property
+    def variance(self):
+        # Population variance, as numpy.var (numpy.nanvar).
+        variance = self.m2 / np.maximum(self.count, 1)
+        return np.where(self.count > 0, variance, np.nan)
+
+    @property
+    def std(self):
+        return np.sqrt(self.variance)
+
+    def standardize(self, data, chunk_size=256):
+        """
+        Centers and scales `data` in place, `chunk_size` rows at a time.
+        Columns with a null variance are set to 0.
+        """
+
+        std = np.nan_to_num(self.std)
+        scale = np.zeros_like(std)
+        scale[std > 0] = 1. / std[std > 0]
+        for start in range(0, data.shape[0], chunk_size):
+            chunk = data[start:start + chunk_size]
+            chunk -= self.mean.astype(chunk.dtype)
+            chunk *= scale.astype(chunk.dtype)
+        return data
+
+    def save(self, path):
+        with open(path, 'wb') as f:
+            np.savez(f, count=self.count, mean=self.mean, m2=self.m2)
+
+    @classmethod
+    def load(cls, path):
+        stats = cls()
+        with np.load(path) as f:
+            stats.count = f['count'] * np.ones_like(f['mean'])  # A single count, for the files from before the NaN.
+            stats.mean = f['mean']
+            stats.m2 = f['m2']
+        return stats
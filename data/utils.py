@@ -1,13 +1,33 @@
 import logging
 import numpy as np
-from torch.utils.data import DataLoader
-from torch.utils.data.sampler import SubsetRandomSampler
+import scipy.sparse
+from torch.utils.data.sampler import SubsetRandomSampler, SequentialSampler, BatchSampler
 from gene_datasets import BRCACoexpr, GBMDataset, TCGATissue, NSLRSyntheticDataset, DGEXGEO, TCGAGeneInference
 from datasets import RandomDataset, PercolateDataset
 import data, data.colombos
 import academictorrents as at
 
 
+class BatchLoader(object):
+    """
+    Replacement of the DataLoader that fetches each batch with one call to `dataset.get_batch(indices)`,
+    instead of getting and collating the examples one by one.
+    """
+
+    def __init__(self, dataset, batch_size=1, sampler=None, drop_last=False):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.sampler = sampler if sampler is not None else SequentialSampler(dataset)
+        self.batch_sampler = BatchSampler(self.sampler, batch_size, drop_last)
+
+    def __iter__(self):
+        for idx in self.batch_sampler:
+            yield self.dataset.get_batch(idx)
+
+    def __len__(self):
+        return len(self.batch_sampler)
+
+
 def split_dataset(dataset, batch_size=100, random=False, train_ratio=0.8, seed=1993, nb_samples=None, nb_per_class=None):
     logger = logging.getLogger()
     all_idx = range(len(dataset))
@@ -66,9 +86,9 @@ def split_dataset(dataset, batch_size=100, random=False, train_ratio=0.8, seed=1
         idx_valid = all_idx[nb_train:nb_valid]
         idx_test = all_idx[nb_valid:nb_test]
 
-    train_set = DataLoader(dataset, batch_size=batch_size, sampler=SubsetRandomSampler(idx_train))
-    test_set = DataLoader(dataset, batch_size=batch_size, sampler=SubsetRandomSampler(idx_test))
-    valid_set = DataLoader(dataset, batch_size=batch_size, sampler=SubsetRandomSampler(idx_valid))
+    train_set = BatchLoader(dataset, batch_size=batch_size, sampler=SubsetRandomSampler(idx_train))
+    test_set = BatchLoader(dataset, batch_size=batch_size, sampler=SubsetRandomSampler(idx_test))
+    valid_set = BatchLoader(dataset, batch_size=batch_size, sampler=SubsetRandomSampler(idx_valid))
     logger.info("Our sets are of length: train={}, valid={}, tests={}".format(len(idx_train), len(idx_valid), len(idx_test)))
     return train_set, valid_set, test_set
 
@@ -151,6 +171,15 @@ def add_noise(dataset, num_added_nodes=10):
 
 def subsample_graph(adj, percentile=100):
     # if we want to sub-sample the edges, based on the edges value
+    if percentile < 100 and scipy.sparse.issparse(adj):
+        adj = scipy.sparse.csr_matrix(adj, copy=True)
+        threshold = np.percentile(adj.data[adj.data != 0.], 100 - percentile)
+        logging.info("We will remove all the edges that has a value smaller than {}".format(threshold))
+
+        adj.data[adj.data < threshold] = 0.
+        adj.eliminate_zeros()
+        return adj
+
     if percentile < 100:
         # small trick to ignore the 0.
         nan_adj = np.ma.masked_where(adj == 0., adj)
@@ -8,19 +8,30 @@ import torch
 import logging
 import numpy as np
 from torch import nn
+import torch.nn.functional as F
 from torch.autograd import Variable
 import os
 from torchvision import transforms
 import sklearn
 import sklearn.cluster
+import scipy.sparse
+import scipy.sparse.linalg
+import shutil
+import tempfile
+from data.digest import hash_adj
 
-class PoolGraph(object):
+class PoolGraph(nn.Module):
 
     """
     Given x values, a adjacency graph, and a list of value to keep, return the coresponding x.
+
+    The adj is kept as an edge list (column by column), so the pooling is a segment reduction over the
+    neighbours of each node and never builds the dense (ex * channel, node, node) tensor.
+    The edges and the mask are buffers, built once, that follow the module's .cuda()/.to().
     """
 
     def __init__(self, adj, to_keep, please_ignore=False, type='max', on_cuda=False, **kwargs):
+        super(PoolGraph, self).__init__()
 
         self.type = type
         self.please_ignore = please_ignore
@@ -34,50 +45,137 @@ class PoolGraph(object):
             logging.info("We are keeping all the nodes. ignoring the agregation step.")
             self.please_ignore = True
 
-    def __call__(self, x):
+        if not self.please_ignore:
+            self.init_edges()
+
+        if self.on_cuda:
+            self.cuda()
+
+    def init_edges(self):
+
+        # Node j pools over all the nodes i where adj[i, j] != 0, so we go column by column.
+        adj = scipy.sparse.csc_matrix(self.adj, dtype=np.float32)
+        adj.eliminate_zeros()
+        adj.sort_indices()
+        degrees = np.diff(adj.indptr)
+
+        self.register_buffer('src', torch.LongTensor(adj.indices.astype(np.int64)))
+        self.register_buffer('dst', torch.LongTensor(np.repeat(np.arange(self.nb_nodes), degrees)))
+        self.register_buffer('weights', torch.FloatTensor(adj.data))
+
+        # The dense max also sees the 0. of all the missing edges, only a full column doesn't.
+        floor = np.where(degrees < self.nb_nodes, 0., -np.inf).astype(np.float32)
+        self.register_buffer('floor', torch.FloatTensor(floor))
+
+        # For the max, the edges of each node are padded to a power of two, so the padding is at most 2x the edges.
+        self.nb_buckets = 0
+        order = []
+        for nodes, table in degree_buckets(adj.indptr):
+            mask = np.where(table >= 0, 0., -np.inf).astype(np.float32)
+            self.register_buffer('bucket_table_{}'.format(self.nb_buckets), torch.LongTensor(table.clip(0).reshape(-1)))
+            self.register_buffer('bucket_mask_{}'.format(self.nb_buckets), torch.FloatTensor(mask))
+            self.nb_buckets += 1
+            order.append(nodes)
+
+        # Where each node ends up once all the buckets are concatenated. Nodes without edge point to the padding.
+        order = np.concatenate(order + [np.zeros((0,), dtype=np.int64)])
+        position = np.full((self.nb_nodes,), len(order), dtype=np.int64)
+        position[order] = np.arange(len(order))
+        self.register_buffer('position', torch.LongTensor(position))
+        self.register_buffer('keep', torch.FloatTensor(self.to_keep.astype(np.float32)))
+
+    def forward(self, x):
         # x if of the shape (ex, node, channel)
         if self.please_ignore:
             return x
 
-        adj = Variable(torch.FloatTensor(self.adj), requires_grad=False)
-        to_keep = Variable(torch.FloatTensor(self.to_keep.astype(float)), requires_grad=False)
-        if self.on_cuda:
-            adj = adj.cuda()
-            to_keep = to_keep.cuda()
-
-        x = x.permute(0, 2, 1).contiguous()  # put in ex, channel, node
         x_shape = x.size()
+        x = x.transpose(0, 1).contiguous().view(x_shape[1], -1)  # put in node, ex * channel
 
         if self.type == 'max':
-            max_value = (x.view(-1, x.size(-1), 1) * adj).max(dim=1)[0]
+            values = x.index_select(0, self.src) * self.weights.type_as(x).unsqueeze(1)  # (edges, ex * channel)
+            pooled = []
+            for i in range(self.nb_buckets):
+                table, mask = getattr(self, 'bucket_table_{}'.format(i)), getattr(self, 'bucket_mask_{}'.format(i))
+                bucket = values.index_select(0, table).view(mask.size(0), mask.size(1), -1) + mask.type_as(x).unsqueeze(2)
+                pooled.append(bucket.max(dim=1)[0])
+            pooled.append(x.new_full((1, x.size(1)), -np.inf))  # for the nodes without edge.
+            max_value = torch.cat(pooled, dim=0).index_select(0, self.position)
+            max_value = torch.max(max_value, self.floor.type_as(x).unsqueeze(1))
         elif self.type == 'mean':
-            max_value = (x.view(-1, x.size(-1), 1) * adj).mean(dim=1)
+            values = x.index_select(0, self.src) * self.weights.type_as(x).unsqueeze(1)
+            max_value = x.new_zeros(x.size()).index_add(0, self.dst, values) / self.nb_nodes
         elif self.type == 'strip':
-            max_value = x.view(-1, x.size(-1))
+            max_value = x
         else:
             raise ValueError()
 
-        retn = max_value * to_keep  # Zero out The one that we don't care about.
-        retn = retn.view(x_shape).permute(0, 2, 1).contiguous()  # put back in ex, node, channel
+        retn = max_value * self.keep.type_as(x).unsqueeze(1)  # Zero out The one that we don't care about.
+        retn = retn.view(x_shape[1], x_shape[0], x_shape[2]).transpose(0, 1).contiguous()  # put back in ex, node, channel
         return retn
 
 
+def degree_buckets(indptr):
+
+    """
+    Group the rows of a CSR (or columns of a CSC) structure by their degree, rounded up to a power of two.
+    :param indptr: The indptr of the sparse matrix.
+    :return: A list of (nodes, table). table[k, e] is the position of the e-th edge of nodes[k], -1 is padding.
+    """
+
+    degrees = np.diff(indptr)
+    widths = np.zeros(degrees.shape, dtype=np.int64)
+    widths[degrees > 0] = 2 ** np.ceil(np.log2(degrees[degrees > 0])).astype(np.int64)
+
+    buckets = []
+    for width in np.unique(widths[widths > 0]):
+        nodes = np.where(widths == width)[0]
+        offsets = np.arange(width)
+        table = indptr[nodes][:, None] + offsets
+        table[offsets >= degrees[nodes][:, None]] = -1
+        buckets.append((nodes, table))
+
+    return buckets
+
+
 class AggregationGraph(object):
 
     """
     Master Agregator. Will return the agregator function and the adj for each layer of the network.
+
+    Args:
+        processed_dir (string): Where to cache the hierarchy. None to always recompute it.
+        unique_id (string): Describe the adj_transform, since it's part of the cache key.
     """
 
-    def __init__(self, adj, nb_layer, adj_transform=None, on_cuda=False, cluster_type=None, **kwargs):
+    def __init__(self, adj, nb_layer, adj_transform=None, on_cuda=False, cluster_type=None,
+                 processed_dir=None, unique_id=None, **kwargs):
 
         self.nb_layer = nb_layer
         self.adj = adj
         self.on_cuda = on_cuda
         self.adj_transform = adj_transform
         self.cluster_type = cluster_type
+        self.unique_id = unique_id
+
+        self.processed_path = None
+        if processed_dir:
+            import getpass
+            adj_hash = hash_adj(self.adj, self.nb_layer, self.cluster_type, self.unique_id)
+            self.processed_path = os.path.join(processed_dir, "AggregationGraph-" + str(getpass.getuser()), adj_hash)
 
         # Build the hierarchy of clusters.
-        self.init_cluster()  # Compute all the adjs and to_keep variables.
+        if self.processed_path and os.path.exists(self.processed_path):
+            logging.info("Loading the saved hierarchy from {}".format(self.processed_path))
+            self.load_cluster(self.processed_path)
+        else:
+            self.init_cluster()  # Compute all the adjs and to_keep variables.
+            if self.processed_path:
+                logging.info("Saving the hierarchy in {}".format(self.processed_path))
+                try:
+                    self.save_cluster(self.processed_path)
+                except (IOError, OSError) as e:  # The cache is only an optimization.
+                    logging.warning("Could not save the hierarchy in {}: {}".format(self.processed_path, e))
 
         # Build the aggregate function
         self.aggregates = []
@@ -104,7 +202,10 @@ class AggregationGraph(object):
 
             all_transformed_adj.append(current_adj)
 
-            to_keep, adj = self.cluster_specific_layer(to_keep, no_layer, np.array(current_adj))
+            if not scipy.sparse.issparse(current_adj):
+                current_adj = np.array(current_adj)
+
+            to_keep, adj = self.cluster_specific_layer(to_keep, no_layer, current_adj)
             all_to_keep.append(to_keep)
             all_aggregate_adjs.append(adj)
 
@@ -114,6 +215,45 @@ class AggregationGraph(object):
         self.aggregate_adjs = all_aggregate_adjs
         self.adjs = all_transformed_adj
 
+    def save_cluster(self, processed_path):
+
+        # Write everything in a temporary directory first, so a concurrent run never sees half a hierarchy.
+        parent = os.path.dirname(processed_path)
+        if not os.path.exists(parent):
+            os.makedirs(parent)
+        tmp_path = tempfile.mkdtemp(dir=parent)
+
+        for no_layer in range(self.nb_layer):
+            save_sparse(os.path.join(tmp_path, 'adj_{}'.format(no_layer)), self.adjs[no_layer])
+            save_sparse(os.path.join(tmp_path, 'aggregate_adj_{}'.format(no_layer)), self.aggregate_adjs[no_layer])
+            np.save(os.path.join(tmp_path, 'to_keep_{}.npy'.format(no_layer)), self.to_keeps[no_layer])
+        np.save(os.path.join(tmp_path, 'is_sparse.npy'), [scipy.sparse.issparse(adj) for adj in self.adjs])
+
+        try:
+            os.rename(tmp_path, processed_path)
+        except OSError:  # Somebody else saved it first.
+            shutil.rmtree(tmp_path)
+
+    def load_cluster(self, processed_path):
+
+        is_sparse = np.load(os.path.join(processed_path, 'is_sparse.npy'))
+
+        self.adjs = []
+        self.aggregate_adjs = []
+        self.to_keeps = []
+        for no_layer in range(self.nb_layer):
+            adj = load_sparse(os.path.join(processed_path, 'adj_{}'.format(no_layer)))
+            aggregate_adj = load_sparse(os.path.join(processed_path, 'aggregate_adj_{}'.format(no_layer)))
+
+            # Give back the same kind of adj that we would have computed.
+            if not is_sparse[no_layer]:
+                adj = adj.toarray()
+                aggregate_adj = aggregate_adj.toarray()
+
+            self.adjs.append(adj)
+            self.aggregate_adjs.append(aggregate_adj)
+            self.to_keeps.append(np.load(os.path.join(processed_path, 'to_keep_{}.npy'.format(no_layer))))
+
     def get_nodes_cluster(self, last_to_keep, layer_id, adj):
         # TODO: add other kind of clustering (i.e. random, grid, etc.)
 
@@ -124,9 +264,13 @@ class AggregationGraph(object):
             n_clusters = nb_nodes / (2 ** (layer_id + 1))
             # For a specific layer, return the ids. The merging and stuff's gonna be compute later.
             self.clustering = sklearn.cluster.AgglomerativeClustering(n_clusters=n_clusters, affinity='euclidean',
-                                                                      memory='testing123_123', connectivity=(adj > 0.).astype(int),
+                                                                      connectivity=(adj > 0.).astype(int),
                                                                       compute_full_tree='auto', linkage='ward')
-            ids = self.clustering.fit_predict(self.adj)  # all nodes has a cluster.
+            features = adj.toarray() if scipy.sparse.issparse(adj) else adj
+            ids = self.clustering.fit_predict(features)  # all nodes has a cluster.
+        elif self.cluster_type == 'matching':
+            # Pair the centroids of the previous layer along their heaviest edges, the other nodes stay alone.
+            ids = heavy_edge_matching(adj, nodes=np.asarray(last_to_keep) == 1.)
         elif self.cluster_type is None or self.cluster_type == 'ignore':
             pass
         elif self.cluster_type == 'grid':
@@ -140,23 +284,28 @@ class AggregationGraph(object):
     def cluster_specific_layer(self, last_to_keep, n_clusters, adj):
         # A cluster for a specific scale.
         ids = self.get_nodes_cluster(last_to_keep, n_clusters, adj)
-        n_clusters = len(set(ids))
+        clusters, ids = np.unique(ids, return_inverse=True)
+        nb_nodes = adj.shape[0]
 
-        clusters = set([])
-        to_keep = np.zeros((adj.shape[0],))
-        cluster_adj = np.zeros((n_clusters, self.adj.shape[0]))
+        # To keep a node, it had to be a centroid of a previous layer. Otherwise it might not work.
+        # The first of those nodes in each cluster becomes the new centroid.
+        to_keep = np.zeros((nb_nodes,))
+        candidates = np.where(np.asarray(last_to_keep) == 1.)[0]
+        _, first = np.unique(ids[candidates], return_index=True)
+        to_keep[candidates[first]] = 1.
 
-        for i, cluster in enumerate(ids):
-            if last_to_keep[i] == 1.:  # To keep a node, it had to be a centroid of a previous layer. Otherwise it might not work.
-                if cluster not in clusters:
-                    clusters.add(cluster)
-                    to_keep[i] = 1.
+        # assignment[i, c] is 1 if the node i is in the cluster c.
+        assignment = scipy.sparse.csr_matrix((np.ones(nb_nodes), (np.arange(nb_nodes), ids)),
+                                             shape=(nb_nodes, len(clusters)))
 
-            cluster_adj[cluster] += adj[i]  # The centroid is the merged of all the adj of all the nodes inside it.
+        # The centroid is the merged of all the adj of all the nodes inside it.
+        cluster_adj = assignment.T.dot(scipy.sparse.csr_matrix(adj)).tocsr()
 
-        new_adj = np.zeros((adj.shape[0], adj.shape[0]))  # rewrite the adj matrix.
-        for i, cluster in enumerate(ids):
-            new_adj[i] += (cluster_adj[cluster] > 0.).astype(int)
+        # rewrite the adj matrix, each node gets the adj of its cluster.
+        cluster_adj = (cluster_adj > 0.).astype(float)
+        if not scipy.sparse.issparse(adj):
+            cluster_adj = cluster_adj.toarray()
+        new_adj = cluster_adj[ids]
 
         return to_keep, new_adj
 
@@ -170,6 +319,72 @@ class AggregationGraph(object):
         return self.adjs[layer_id]
 
 
+def heavy_edge_matching(adj, nodes=None):
+
+    """
+    Graclus-like coarsening: each node is paired with a free neighbour, heaviest w_ij * (1 / d_i + 1 / d_j) first.
+    The edges are sorted once, and matched greedily in that order, so it is O(E log E) whatever the graph.
+    Ties go to the smallest indices.
+    :param adj: The adj matrix, dense or sparse.
+    :param nodes: A boolean mask of the nodes that can be matched. The others stay in their own cluster.
+    :return: The cluster id of each node.
+    """
+
+    adj = scipy.sparse.csr_matrix(adj, dtype=float)
+    adj = abs(adj.maximum(adj.T)).tocoo()
+    nb_nodes = adj.shape[0]
+
+    # No self loop in a matching.
+    no_loop = (adj.row != adj.col) & (adj.data != 0.)
+    row, col, weights = adj.row[no_loop], adj.col[no_loop], adj.data[no_loop]
+
+    degrees = np.bincount(row, weights=weights, minlength=nb_nodes)
+    inv_degrees = 1. / np.maximum(degrees, np.finfo(float).tiny)
+    weights = weights * (inv_degrees[row] + inv_degrees[col])
+
+    free = np.ones((nb_nodes,), dtype=bool) if nodes is None else np.array(nodes, dtype=bool)
+    partner = np.arange(nb_nodes)
+
+    # The adj is symmetric, we only need each edge once, and only between nodes that can be matched.
+    keep = (row < col) & free[row] & free[col]
+    row, col, weights = row[keep], col[keep], weights[keep]
+
+    order = np.lexsort((col, row, -weights))
+    free = free.tolist()
+    for i, j in zip(row[order].tolist(), col[order].tolist()):
+        if free[i] and free[j]:
+            partner[i], partner[j] = j, i
+            free[i] = free[j] = False
+
+    return np.minimum(np.arange(nb_nodes), partner)
+
+
+def save_sparse(path, adj):
+
+    """
+    Save a matrix as its CSR arrays, each in its own .npy, so they can be memory-mapped back.
+    """
+
+    adj = scipy.sparse.csr_matrix(adj)
+    np.save(path + '_data.npy', adj.data)
+    np.save(path + '_indices.npy', adj.indices)
+    np.save(path + '_indptr.npy', adj.indptr)
+    np.save(path + '_shape.npy', adj.shape)
+
+
+def load_sparse(path, mmap_mode='r'):
+
+    """
+    Load a matrix saved with save_sparse, the CSR arrays are memory-mapped.
+    """
+
+    data = np.load(path + '_data.npy', mmap_mode=mmap_mode)
+    indices = np.load(path + '_indices.npy', mmap_mode=mmap_mode)
+    indptr = np.load(path + '_indptr.npy', mmap_mode=mmap_mode)
+    shape = tuple(np.load(path + '_shape.npy'))
+    return scipy.sparse.csr_matrix((data, indices, indptr), shape=shape, copy=False)
+
+
 class SelfConnection(object):
 
     """
@@ -184,6 +399,16 @@ class SelfConnection(object):
 
         logging.info("Adding self connection!")
 
+        if scipy.sparse.issparse(adj):
+            # Same as fill_diagonal, without changing the sparsity structure in place.
+            adj = scipy.sparse.csr_matrix(adj)
+            adj = adj - scipy.sparse.diags(adj.diagonal())
+            if self.add_self_connection:
+                adj = adj + scipy.sparse.identity(adj.shape[0], dtype=adj.dtype)
+            adj = adj.tocsr()
+            adj.eliminate_zeros()
+            return adj
+
         if self.add_self_connection:
             np.fill_diagonal(adj, 1.)
         else:
@@ -199,12 +424,13 @@ class ApprNormalizeLaplacian(object):
     Args:
         processed_path (string): Where to save the processed normalized adjency matrix.
         overwrite (bool): If we want to overwrite the saved processed data.
+        sparse (bool): Return a scipy.sparse matrix, computed in O(E). Sparse inputs always take that path.
 
     """
 
     # TODO: add unittests
     def __init__(self, processed_dir='/Tmp/',
-                 processed_file=None, unique_id=None, overwrite=False, **kwargs):
+                 processed_file=None, unique_id=None, overwrite=False, sparse=False, **kwargs):
 
         import getpass
 
@@ -212,11 +438,13 @@ class ApprNormalizeLaplacian(object):
         self.processed_file = processed_file
         self.overwrite = overwrite
         self.unique_id = unique_id
+        self.sparse = sparse
 
     def __call__(self, adj):
 
-        adj = np.array(adj)
-        adj_hash = str(hash(str(adj))) + str(adj.shape)
+        sparse = self.sparse or scipy.sparse.issparse(adj)
+        adj = scipy.sparse.csr_matrix(adj) if sparse else np.array(adj)
+        adj_hash = hash_adj(adj)
         processed_path = None
         if self.processed_dir and self.processed_file:
             processed_path = os.path.join(self.processed_dir, self.processed_file)
@@ -224,38 +452,62 @@ class ApprNormalizeLaplacian(object):
             if not os.path.exists(processed_path):
                 os.makedirs(processed_path)
 
-            processed_path = processed_path + adj_hash + '_{}.npy'.format(self.unique_id)
+            processed_path = processed_path + adj_hash + '_{}.{}'.format(self.unique_id, 'npz' if sparse else 'npy')
 
             if not self.overwrite and os.path.exists(processed_path):
                 logging.info("returning a saved transformation.")
-                return np.load(processed_path)
+                return scipy.sparse.load_npz(processed_path) if sparse else np.load(processed_path)
 
         logging.info("Doing the approximation...")
 
-        # Fill the diagonal
-        np.fill_diagonal(adj, 1.)  # TODO: Hummm, think it's a 0.
+        if sparse:
+            norm_transform = self.sparse_normalize(adj)
+        else:
+            # Fill the diagonal
+            np.fill_diagonal(adj, 1.)  # TODO: Hummm, think it's a 0.
 
-        D = adj.sum(axis=1)
-        D_inv = np.diag(1. / np.sqrt(D))
-        norm_transform = D_inv.dot(adj).dot(D_inv)
+            D = adj.sum(axis=1)
+            D_inv = np.diag(1. / np.sqrt(D))
+            norm_transform = D_inv.dot(adj).dot(D_inv)
 
         logging.info("Done!")
 
         # saving the processed approximation
         if processed_path:
             logging.info("Saving the approximation in {}".format(processed_path))
-            np.save(processed_path, norm_transform)
+            if sparse:
+                scipy.sparse.save_npz(processed_path, norm_transform)
+            else:
+                np.save(processed_path, norm_transform)
             logging.info("Done!")
 
         return norm_transform
 
+    def sparse_normalize(self, adj):
+
+        # Fill the diagonal, without changing the sparsity structure in place.
+        nb_nodes = adj.shape[0]
+        adj = adj - scipy.sparse.diags(adj.diagonal()) + scipy.sparse.identity(nb_nodes, dtype=adj.dtype)
+
+        # Scale the rows and the columns, the nodes with no degree are left at 0.
+        D = np.asarray(adj.sum(axis=1)).reshape(-1)
+        D_inv = np.zeros(D.shape, dtype=adj.dtype)
+        D_inv[D > 0] = 1. / np.sqrt(D[D > 0])
+        D_inv = scipy.sparse.diags(D_inv)
+
+        norm_transform = D_inv.dot(adj).dot(D_inv).tocsr()
+        norm_transform.eliminate_zeros()
+        return norm_transform
+
 
 class AugmentGraphConnectivity(object):
 
-    def __init__(self, kernel_size=1, please_ignore=False, **kwargs):
+    def __init__(self, kernel_size=1, please_ignore=False, sparse=False, max_neighbours=None, **kwargs):
 
         self.kernel_size = kernel_size
         self.please_ignore = please_ignore
+        self.sparse = sparse
+        self.max_neighbours = max_neighbours
 
     def __call__(self, adj):
 
@@ -265,6 +517,8 @@ class AugmentGraphConnectivity(object):
         :param stride: The stride of the pooling. Akin to CNN.
         :param kernel_size: The size of the neibourhood. Same thing as in CNN.
         :param please_ignore: We are not doing pruning, this option is to make things more consistant.
+        :param sparse: Return a scipy.sparse matrix. Sparse inputs always do.
+        :param max_neighbours: Only keep, for each node, the neighbours with the most paths to it, to bound the memory.
         :return:
         """
 
@@ -281,6 +535,11 @@ class AugmentGraphConnectivity(object):
         degrees = adj.sum(axis=0)
         degrees = np.argsort(degrees)[::-1]
 
+        sparse = self.sparse or scipy.sparse.issparse(adj)
+        if sparse or self.max_neighbours is not None:
+            new_adj = self.sparse_augment(scipy.sparse.csr_matrix(adj))
+            return new_adj if sparse else new_adj.toarray()
+
         current_adj = adj
         # We link all the neighbour of the neighbour (times kernel_size) to our node.
         for i in range(kernel_size):
@@ -292,6 +551,61 @@ class AugmentGraphConnectivity(object):
 
         return new_adj
 
+    def sparse_augment(self, adj):
+
+        # Same as the dense version, but we go back to a boolean graph after each product so it stays cheap.
+        current_adj = (adj > 0).astype(float)
+        for i in range(self.kernel_size):
+            transposed = current_adj.T.tocsr()
+            if self.max_neighbours is None:
+                current_adj = current_adj.dot(transposed)
+            else:
+                # Block of rows by block of rows, so the uncapped product is never all in memory.
+                block_size = 1024
+                current_adj = scipy.sparse.vstack([top_k_per_row(current_adj[start:start + block_size].dot(transposed).tocsr(),
+                                                                 self.max_neighbours)
+                                                   for start in range(0, current_adj.shape[0], block_size)])
+            current_adj = (current_adj.tocsr() > 0).astype(float)
+
+        return current_adj
+
+
+def top_k_per_row(adj, k, chunk_size=2 ** 22):
+
+    """
+    Keep the k largest values of each row of a sparse matrix.
+    :param adj: A CSR matrix.
+    :param k: The maximum number of values per row.
+    :param chunk_size: Roughly how many values we look at, at a time.
+    :return: A CSR matrix.
+    """
+
+    degrees = np.diff(adj.indptr)
+    to_cap = np.where(degrees > k)[0]
+    if len(to_cap) == 0:
+        return adj
+
+    keep = np.ones(adj.nnz, dtype=bool)
+    nb_rows = max(1, chunk_size // degrees.max())
+    for start in range(0, len(to_cap), nb_rows):
+        rows = to_cap[start:start + nb_rows]
+
+        # Pad the rows to the same length, so we can partition them all at once.
+        offsets = np.arange(degrees[rows].max())
+        table = adj.indptr[rows][:, None] + offsets
+        padding = offsets >= degrees[rows][:, None]
+        table[padding] = 0
+        values = adj.data[table]
+        values[padding] = -np.inf
+
+        top = np.argpartition(-values, k - 1, axis=1)[:, :k]
+        keep[table[~padding]] = False
+        keep[table[np.arange(len(rows))[:, None], top]] = True
+
+    adj = scipy.sparse.csr_matrix((adj.data[keep], adj.indices[keep], np.concatenate([[0], np.cumsum(np.minimum(degrees, k))])),
+                                  shape=adj.shape)
+    return adj
+
 
 class GraphLayer(nn.Module):
     def __init__(self, adj, in_dim=1, channels=1, on_cuda=False, id_layer=None,
@@ -326,33 +640,60 @@ class GraphLayer(nn.Module):
 
 class SparseMM(torch.autograd.Function):
     """
-    Sparse x dense matrix multiplication with autograd support.
+    Sparse x dense matrix multiplication with autograd support. Use it as SparseMM.apply(sparse, dense).
+    The backward is itself a SparseMM, so it can be differentiated again.
+    There is no half precision sparse mm on the cpu, so float16/bfloat16 are computed in float32 there.
     Implementation by Soumith Chintala:
     https://discuss.pytorch.org/t/
     does-pytorch-support-autograd-on-sparse-matrix/6156/7
     From: https://github.com/tkipf/pygcn/blob/master/pygcn/layers.py
     """
 
-    def __init__(self, sparse):
-        super(SparseMM, self).__init__()
-        self.sparse = sparse
+    low_precision = [dtype for dtype in [torch.float16, getattr(torch, 'bfloat16', None)] if dtype is not None]
 
-    def forward(self, dense):
-        return torch.mm(self.sparse, dense)
+    @staticmethod
+    def forward(ctx, sparse, dense):
+        ctx.sparse = sparse
 
-    def backward(self, grad_output):
+        if not dense.is_cuda and dense.dtype in SparseMM.low_precision:
+            return torch.mm(sparse.float(), dense.float()).to(dense.dtype)
+        if sparse.dtype != dense.dtype:
+            sparse = sparse.to(dense.dtype)
+        return torch.mm(sparse, dense)
+
+    @staticmethod
+    def backward(ctx, grad_output):
         grad_input = None
-        if self.needs_input_grad[0]:
-            grad_input = torch.mm(self.sparse.t(), grad_output)
-        return grad_input
+        if ctx.needs_input_grad[1]:
+            grad_input = SparseMM.apply(ctx.sparse.t(), grad_output)
+        return None, grad_input
 
 
 class CGNLayer(GraphLayer):
 
+    """
+    Graph convolution, https://arxiv.org/pdf/1609.02907.pdf
+
+    Args:
+        precomputed (bool): The input is already propagated, A^k x (see data.propagation.propagate_expression),
+            so we skip the sparse product. The raw x is not there anymore, so the layer is a single branch, SGC-like:
+            one linear map from A^k x to all the channels, and no eye_linear.
+    """
+
+    def __init__(self, adj, precomputed=False, **kwargs):
+        self.precomputed = precomputed
+        super(CGNLayer, self).__init__(adj, **kwargs)
+
     def init_params(self):
-        self.edges = torch.LongTensor(np.array(np.where(self.adj)))  # The list of edges
-        flat_adj = self.adj.flatten()[np.where(self.adj.flatten())]  # get the value
-        flat_adj = torch.FloatTensor(flat_adj)
+        if self.precomputed:
+            self.linear = nn.Conv1d(self.in_dim, self.channels, 1, bias=True)
+            self.eye_linear = None
+            return
+
+        adj = scipy.sparse.coo_matrix(self.adj)  # Same (row-major) order as np.where, for dense adjs.
+        adj.eliminate_zeros()
+        self.edges = torch.LongTensor(np.array([adj.row, adj.col], dtype=np.int64))  # The list of edges
+        flat_adj = torch.FloatTensor(adj.data.astype(np.float32))  # get the value
 
         # Constructing a sparse matrix
         logging.info("Constructing the sparse matrix...")
@@ -362,29 +703,32 @@ class CGNLayer(GraphLayer):
         self.eye_linear = nn.Conv1d(self.in_dim, self.channels/2, 1, bias=True)
 
     def _adj_mul(self, x, D):
-        nb_examples, nb_channels, nb_nodes = x.size()
-        x = x.view(-1, nb_nodes)
-
+        # x is node-major, (node, ex, ch), so D sees a (node, ex * ch) matrix without any copy.
         # Needs this hack to work: https://discuss.pytorch.org/t/does-pytorch-support-autograd-on-sparse-matrix/6156/7
-        #x = D.mm(x.t()).t()
-        x = SparseMM(D)(x.t()).t()
-
-        x = x.contiguous().view(nb_examples, nb_channels, nb_nodes)
-        return x
+        return SparseMM.apply(D, x.view(x.size(0), -1)).view(x.size())
 
     def forward(self, x):
 
-        x = x.permute(0, 2, 1).contiguous()  # from ex, node, ch, -> ex, ch, node
-
-        adj = Variable(self.sparse_adj, requires_grad=False)
+        if self.precomputed:
+            x = F.linear(x, self.linear.weight.squeeze(-1), self.linear.bias)
+            if self.aggregate_adj:
+                x = self.aggregate_adj(x)
+            return x
 
-        eye_x = self.eye_linear(x)
+        # The 1x1 convs are linear maps on the channels, so they work on any layout and we never permute back.
+        eye_x = F.linear(x, self.eye_linear.weight.squeeze(-1), self.eye_linear.bias)
 
-        x = self._adj_mul(x, adj)  # + old_x# local average
+        # The only layout copy: from ex, node, ch -> node, ex, ch, the layout of the sparse product.
+        x = x.transpose(0, 1).contiguous()
 
-        x = torch.cat([self.linear(x), eye_x], dim=1)  # + old_x# conv
+        # A (x W) + b == (A x) W + b, so we propagate on whichever side has the less channels.
+        weight = self.linear.weight.squeeze(-1)
+        if weight.size(0) < weight.size(1):
+            x = self._adj_mul(F.linear(x, weight), self.sparse_adj) + self.linear.bias  # local average
+        else:
+            x = F.linear(self._adj_mul(x, self.sparse_adj), weight, self.linear.bias)  # local average
 
-        x = x.permute(0, 2, 1).contiguous()  # from ex, ch, node -> ex, node, ch
+        x = torch.cat([x.transpose(0, 1), eye_x], dim=2)  # + old_x# conv
 
         # We can do max pooling and stuff, if we want.
         if self.aggregate_adj:
@@ -395,63 +739,95 @@ class CGNLayer(GraphLayer):
 
 class LCGLayer(GraphLayer):
 
-    def init_params(self):
-        logging.info("Constructing the network...")
-        self.max_edges = sorted((self.adj > 0.).sum(0))[-1]
-
-        logging.info("Each node will have {} edges.".format(self.max_edges))
-
-        # Get the list of all the edges. All the first index is 0, we fix that later
-        edges_np = [np.asarray(np.where(self.adj[i:i + 1] > 0.)).T for i in range(len(self.adj))]
-
-        # pad the edges, so they all nodes have the same number of edges. help to automate everything.
-        edges_np = [np.concatenate([x, [[0, self.nb_nodes]] * (self.max_edges - len(x))]) if len(x) < self.max_edges
-                    else x[:self.max_edges] if len(x) > self.max_edges  # Some Nodes have too many connection!
-                    else x
-                    for i, x in enumerate(edges_np)]
-
-        # fix the index that was all 0.
-        for i in range(len(edges_np)):
-            edges_np[i][:, 0] = i
-
-        edges_np = np.array(edges_np).reshape(-1, 2)
-        edges_np = edges_np[:, 1:2]
-
-        self.edges = torch.LongTensor(edges_np)
-        self.super_edges = torch.cat([self.edges] * self.channels)
+    """
+    Locally connected graph layer, each node has its own weights for each of its edges.
 
-        # We have one set of parameters per input dim. might be slow, but for now we will do with that.
-        self.my_weights = [nn.Parameter(torch.rand(self.edges.shape[0], self.channels), requires_grad=True) for _ in  # TODO: to glorot
-                           range(self.in_dim)]
-        self.my_weights = nn.ParameterList(self.my_weights)
+    Args:
+        max_edges (int): The nodes with more edges than that are truncated. None to keep all the edges, i.e. to pad
+            to the largest row degree. Before, the default was the largest column degree, so on a non symmetric adj
+            the padding (and the number of weights) can change and rows are no longer silently truncated.
+        bucketed (bool): Pad the edges of each node to the next power of two of its degree, instead of padding
+            all the nodes to max_edges. The memory then follows the real number of edges.
+    """
 
-    def GraphConv(self, x, edges, batch_size, weights):
+    def __init__(self, adj, max_edges=None, bucketed=False, **kwargs):
+        self.max_edges = max_edges
+        self.bucketed = bucketed
+        super(LCGLayer, self).__init__(adj, **kwargs)
 
-        edges = edges.contiguous().view(-1)
-        useless_node = Variable(torch.zeros(x.size(0), 1, x.size(2)))
+    def init_params(self):
+        logging.info("Constructing the network...")
 
-        if self.on_cuda:
-            edges = edges.cuda()
-            weights = weights.cuda()
-            useless_node = useless_node.cuda()
+        # The neighbours of each node, as CSR arrays. Works for dense and sparse adjs.
+        adj = scipy.sparse.csr_matrix(scipy.sparse.csr_matrix(self.adj) > 0.)
+        adj.sort_indices()
+        indices = adj.indices.astype(np.int64)
+        degrees = np.diff(adj.indptr).astype(np.int64)
+        indptr = np.concatenate([[0], np.cumsum(degrees)])
+
+        if self.max_edges is None:
+            self.max_edges = degrees.max()
+        elif (degrees > self.max_edges).any():
+            logging.warning("{} nodes have more than {} edges, we only keep their first {} edges.".format(
+                (degrees > self.max_edges).sum(), self.max_edges, self.max_edges))
+
+        # Truncate the nodes that have too many connection.
+        offsets = np.arange(len(indices)) - np.repeat(indptr[:-1], degrees)
+        indices = indices[offsets < self.max_edges]
+        degrees = np.minimum(degrees, self.max_edges)
+        indptr = np.concatenate([[0], np.cumsum(degrees)])
 
-        x = torch.cat([x, useless_node], 1)  # add a random filler node
-        tocompute = torch.index_select(x, 1, Variable(edges)).view(batch_size, -1, weights.size(-1))
+        logging.info("Each node will have {} edges.".format(self.max_edges))
 
-        conv = tocompute * weights
-        conv = conv.view(-1, self.nb_nodes, self.max_edges, weights.size(-1)).sum(2)
-        return conv
+        # Each bucket is a set of nodes and their edges, padded to the same number. -1 is the padding.
+        if self.bucketed:
+            buckets = degree_buckets(indptr)
+        else:
+            offsets = np.arange(self.max_edges)
+            table = indptr[:-1][:, None] + offsets
+            table[offsets >= degrees[:, None]] = -1
+            buckets = [(np.arange(self.nb_nodes), table)]
+
+        # The padding edges (-1) all point to a filler node, at the end.
+        indices = np.append(indices, self.nb_nodes)
+        edges_np = np.concatenate([indices[bucket_table].reshape(-1) for _, bucket_table in buckets] +
+                                  [np.zeros((0,), dtype=np.int64)])
+        self.register_buffer('edges', torch.LongTensor(edges_np.reshape(-1, 1)))
+        self.buckets = [(len(nodes), table.shape[1]) for nodes, table in buckets]
+
+        # Where each node ends up once the buckets are concatenated, the nodes without edges point to an extra 0.
+        if self.bucketed:
+            order = np.concatenate([nodes for nodes, _ in buckets] + [np.zeros((0,), dtype=np.int64)])
+            position = np.full((self.nb_nodes,), len(order), dtype=np.int64)
+            position[order] = np.arange(len(order))
+            self.register_buffer('position', torch.LongTensor(position))
+
+        # One weight per (edge, input dim, output channel), all in the same tensor.
+        self.my_weights = nn.Parameter(torch.rand(self.edges.shape[0], self.in_dim, self.channels), requires_grad=True)  # TODO: to glorot
 
     def forward(self, x):
 
         nb_examples, nb_nodes, nb_channels = x.size()
-        edges = Variable(self.super_edges, requires_grad=False)
 
-        if self.on_cuda:
-            edges = edges.cuda()
+        # Node major, with a filler node at the end that the padding edges point to.
+        x = torch.cat([x.transpose(0, 1), x.new_zeros(1, nb_examples, nb_channels)], 0)
+
+        # One gather for all the input channels, then (ex, in) x (in, channels) for each edge.
+        neighbours = x.index_select(0, self.edges.view(-1))  # edges, ex, in
+        conv = torch.bmm(neighbours, self.my_weights)  # edges, ex, channels
 
-        # DO all the input channel and sum them.
-        x = sum([self.GraphConv(x[:, :, i].unsqueeze(-1), edges.data, nb_examples, self.my_weights[i]) for i in range(self.in_dim)])
+        # Sum the edges of each node, bucket by bucket.
+        x, start = [], 0
+        for nb_rows, width in self.buckets:
+            x.append(conv[start:start + nb_rows * width].view(nb_rows, width, nb_examples, self.channels).sum(1))
+            start += nb_rows * width
+
+        if self.bucketed:
+            x.append(conv.new_zeros(1, nb_examples, self.channels))
+            x = torch.cat(x, 0).index_select(0, self.position)
+        else:
+            x = x[0]
+        x = x.transpose(0, 1).contiguous()  # ex, node, channels
 
         # We can do max pooling and stuff, if we want.
         if self.aggregate_adj:
@@ -463,6 +839,18 @@ class LCGLayer(GraphLayer):
 # spectral graph conv
 class SGCLayer(GraphLayer):
 
+    """
+    Spectral graph conv, the filter is learned in the eigenbasis of the Laplacian.
+
+    Args:
+        nb_eigen (int): Only use the nb_eigen smallest eigenpairs, found with a sparse Lanczos solver, and learn one
+            weight per eigenvalue. The memory is then O(N * nb_eigen). None for the full basis and a N x N filter.
+    """
+
+    def __init__(self, adj, nb_eigen=None, **kwargs):
+        self.nb_eigen = nb_eigen
+        super(SGCLayer, self).__init__(adj, **kwargs)
+
     def init_params(self):
         if self.channels != 1:
             logging.info("Setting Channels to 1 on SGCLayer, only number of channels supported")
@@ -470,19 +858,46 @@ class SGCLayer(GraphLayer):
 
         logging.info("Constructing the eigenvectors...")
 
-        D = np.diag(self.adj.sum(axis=1))
-        self.L = D - self.adj
+        if self.nb_eigen is not None:
+            g, V = self.truncated_eig()
+            self.register_buffer('g', torch.FloatTensor(g))
+            self.register_buffer('V', torch.FloatTensor(V))
+            self.F = nn.Parameter(torch.rand(self.nb_eigen), requires_grad=True)
+            return
+
+        adj = self.adj.toarray() if scipy.sparse.issparse(self.adj) else self.adj
+        D = np.diag(adj.sum(axis=1))
+        self.L = D - adj
         self.L = torch.FloatTensor(self.L)
         self.g, self.V = torch.eig(self.L, eigenvectors=True)
         self.F = nn.Parameter(torch.rand(self.nb_nodes, self.nb_nodes), requires_grad=True)
 
+    def truncated_eig(self):
+
+        adj = scipy.sparse.csr_matrix(self.adj, dtype=np.float64)
+        adj = (adj + adj.T) / 2.  # The Laplacian has to be symmetric.
+        degrees = np.asarray(adj.sum(axis=1)).reshape(-1)
+        L = scipy.sparse.diags(degrees) - adj
+
+        # The smallest eigenvalues of L are the largest of (c I - L), which Lanczos finds a lot faster.
+        # c = 2 * max degree bounds the spectrum (Gershgorin).
+        c = 2. * np.abs(adj).sum(axis=1).max()
+        g, V = scipy.sparse.linalg.eigsh(c * scipy.sparse.identity(self.nb_nodes) - L, k=self.nb_eigen, which='LA')
+        g = c - g
+
+        order = np.argsort(g)
+        return g[order], V[:, order]
+
     def forward(self, x):
         V = self.V
         if self.on_cuda:
             V = self.V.cuda()
 
         Vx = torch.matmul(torch.transpose(Variable(V), 0, 1), x)
-        FVx = torch.matmul(self.F, Vx)
+        if self.nb_eigen is not None:
+            FVx = self.F.unsqueeze(-1) * Vx
+        else:
+            FVx = torch.matmul(self.F, Vx)
         VFVx = torch.matmul(Variable(V), FVx)
         x = VFVx
 
@@ -493,26 +908,90 @@ class SGCLayer(GraphLayer):
         return x
 
 
+class ChebLayer(GraphLayer):
+
+    """
+    Spectral graph conv with a Chebyshev polynomial of the rescaled Laplacian, based on https://arxiv.org/abs/1606.09375
+    There is no eigendecomposition and no N x N parameter, each order is one sparse product: O(K * E) per sample.
+
+    Args:
+        order (int): K, the order of the polynomial. The filter sees K hops away.
+    """
+
+    def __init__(self, adj, order=3, **kwargs):
+        self.order = order
+        super(ChebLayer, self).__init__(adj, **kwargs)
+
+    def init_params(self):
+        logging.info("Constructing the rescaled Laplacian...")
+
+        adj = scipy.sparse.csr_matrix(self.adj, dtype=np.float64)
+        adj = (adj + adj.T) / 2.  # The Laplacian has to be symmetric.
+        degrees = np.asarray(adj.sum(axis=1)).reshape(-1)
+        L = scipy.sparse.diags(degrees) - adj
+
+        # Put the spectrum in [-1, 1]. 2 * max degree bounds the largest eigenvalue (Gershgorin), so no eigensolver.
+        lmax = max(2. * np.abs(adj).sum(axis=1).max(), np.finfo(np.float32).eps)
+        L = ((2. / lmax) * L - scipy.sparse.identity(self.nb_nodes)).tocoo()
+
+        indices = torch.LongTensor(np.array([L.row, L.col], dtype=np.int64))
+        laplacian = torch.sparse.FloatTensor(indices, torch.FloatTensor(L.data.astype(np.float32)),
+                                             torch.Size([self.nb_nodes, self.nb_nodes]))
+        self.register_buffer('laplacian', laplacian)
+
+        # One (in_dim, channels) weight per order.
+        stdv = 1. / np.sqrt(self.in_dim * (self.order + 1))
+        self.weight = nn.Parameter(torch.Tensor(self.order + 1, self.in_dim, self.channels).uniform_(-stdv, stdv), requires_grad=True)
+        self.bias = nn.Parameter(torch.zeros(self.channels), requires_grad=True)
+
+    def forward(self, x):
+
+        nb_examples, nb_nodes, nb_channels = x.size()
+
+        # Node major, (node, ex * in), so each order is one sparse mm.
+        x = x.transpose(0, 1).contiguous().view(nb_nodes, -1)
+
+        # T_0 = x, T_1 = L x, T_k = 2 L T_k-1 - T_k-2
+        terms = [x]
+        if self.order > 0:
+            terms.append(SparseMM.apply(self.laplacian, x))
+        for k in range(2, self.order + 1):
+            terms.append(2. * SparseMM.apply(self.laplacian, terms[-1]) - terms[-2])
+
+        x = sum([torch.matmul(term.view(nb_nodes, nb_examples, nb_channels), self.weight[k]) for k, term in enumerate(terms)])
+        x = (x + self.bias).transpose(0, 1).contiguous()  # ex, node, channels
+
+        # We can do max pooling and stuff, if we want.
+        if self.aggregate_adj:
+            x = self.aggregate_adj(x)
+
+        return x
+
+
 def get_transform(opt, adj):
 
     """
     Return a list of transform that can be applied to the adjacency matrix.
-    :param opt: the options
+    :param opt: the options. opt.processed_dir, if there, is where the hierarchy is cached (None: not cached).
     :return: The list of transform.
     """
 
     adj_transform = []
+    transform_id = []  # To know which hierarchy we can reuse.
     if opt.add_self:
         logging.info("Adding self connection to the graph...")
         adj_transform += [lambda layer_id: SelfConnection(opt.add_self, please_ignore=False)]  # Add a self connection.
+        transform_id += ['self']
 
     if opt.add_connectivity:
         logging.info("Adding the connectivity after each layer...")
         adj_transform += [lambda layer_id: AugmentGraphConnectivity(please_ignore=layer_id == 0)]  # Augmenting the connectivity of each layer.
+        transform_id += ['connectivity']
 
     if opt.norm_adj:
         logging.info("Normalizing the graph...")
         adj_transform += [lambda layer_id: ApprNormalizeLaplacian(processed_file=opt.graph)]  # Normalize the graph
+        transform_id += ['norm']
 
     #if opt.pool_graph == "ignore":
 #        def get_aggregate(self, layer_id):
@@ -522,7 +1001,8 @@ def get_transform(opt, adj):
 
     # Our adj transform method.
     adj_transform = transforms.Compose(adj_transform)
-    agregator = AggregationGraph(adj, opt.num_layer, adj_transform=adj_transform, on_cuda=opt.cuda, cluster_type=opt.pool_graph)  # TODO: pooling and stuff
+    agregator = AggregationGraph(adj, opt.num_layer, adj_transform=adj_transform, on_cuda=opt.cuda, cluster_type=opt.pool_graph,
+                                 processed_dir=getattr(opt, 'processed_dir', None), unique_id='-'.join(transform_id))  # TODO: pooling and stuff
 
     # I don't want the code to be too class dependant, so I'll two a functions instead.
     # 1. A function to get the adj matrix
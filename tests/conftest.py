@@ -0,0 +1,6 @@
+import sys, os
+myPath = os.path.dirname(os.path.abspath(__file__))
+
+# The models are imported as a package, the data modules import each other by name.
+sys.path.insert(0, myPath + '/../')
+sys.path.append(myPath + '/../data')
@@ -0,0 +1,136 @@
+import time
+import numpy as np
+import scipy.sparse
+import pytest
+
+from models.graphLayer import AggregationGraph, heavy_edge_matching
+
+
+def legacy_cluster_specific_layer(ids, last_to_keep, adj, nb_nodes):
+    # The loops of AggregationGraph.cluster_specific_layer before it was vectorized.
+    n_clusters = max(ids) + 1  # only len(set(ids)) before, which needed contiguous ids.
+
+    clusters = set([])
+    to_keep = np.zeros((adj.shape[0],))
+    cluster_adj = np.zeros((n_clusters, nb_nodes))
+
+    for i, cluster in enumerate(ids):
+        if last_to_keep[i] == 1.:  # To keep a node, it had to be a centroid of a previous layer. Otherwise it might not work.
+            if cluster not in clusters:
+                clusters.add(cluster)
+                to_keep[i] = 1.
+
+        cluster_adj[cluster] += adj[i]  # The centroid is the merged of all the adj of all the nodes inside it.
+
+    new_adj = np.zeros((adj.shape[0], adj.shape[0]))  # rewrite the adj matrix.
+    for i, cluster in enumerate(ids):
+        new_adj[i] += (cluster_adj[cluster] > 0.).astype(int)
+
+    return to_keep, new_adj
+
+
+def random_graph(nb_nodes=60, weighted=False, seed=0):
+    rng = np.random.RandomState(seed)
+    adj = (rng.rand(nb_nodes, nb_nodes) < 0.1).astype(float)
+    if weighted:
+        adj *= rng.rand(nb_nodes, nb_nodes)
+    adj = np.maximum(adj, adj.T)
+    np.fill_diagonal(adj, 1.)
+    return adj
+
+
+def grid_graph(size=8):
+    adj = np.zeros((size * size, size * size))
+    for i in range(size):
+        for j in range(size):
+            node = i * size + j
+            adj[node, node] = 1.
+            if i + 1 < size:
+                adj[node, node + size] = adj[node + size, node] = 1.
+            if j + 1 < size:
+                adj[node, node + 1] = adj[node + 1, node] = 1.
+    return adj
+
+
+GRAPHS = {'random': random_graph(), 'weighted': random_graph(weighted=True), 'grid': grid_graph()}
+
+
+@pytest.mark.parametrize('graph', sorted(GRAPHS))
+@pytest.mark.parametrize('cluster_type', [None, 'grid', 'hierarchy', 'matching'])
+@pytest.mark.parametrize('sparse', [False, True])
+def test_cluster_specific_layer_unchanged(graph, cluster_type, sparse):
+    adj = GRAPHS[graph]
+    if sparse:
+        adj = scipy.sparse.csr_matrix(adj)
+    nb_layer = 3
+    aggregation = AggregationGraph(adj, nb_layer, cluster_type=cluster_type)
+
+    # Replay the hierarchy with the legacy loops, on the same clusters.
+    to_keep = np.ones((adj.shape[0],))
+    current_adj = GRAPHS[graph]
+    for no_layer in range(nb_layer):
+        ids = aggregation.get_nodes_cluster(to_keep, no_layer, current_adj)
+        to_keep, current_adj = legacy_cluster_specific_layer(list(ids), to_keep, current_adj, adj.shape[0])
+
+        new_adj = aggregation.aggregate_adjs[no_layer]
+        assert scipy.sparse.issparse(new_adj) == sparse
+        if sparse:
+            new_adj = new_adj.toarray()
+
+        np.testing.assert_array_equal(aggregation.to_keeps[no_layer], to_keep)
+        np.testing.assert_array_equal(new_adj, current_adj)
+
+
+def test_hierarchy_cache(tmpdir):
+    adj = GRAPHS['grid']
+    computed = AggregationGraph(adj, 3, cluster_type='grid', processed_dir=str(tmpdir))
+    loaded = AggregationGraph(adj, 3, cluster_type='grid', processed_dir=str(tmpdir))
+    assert len(tmpdir.listdir()) == 1
+
+    for no_layer in range(3):
+        np.testing.assert_array_equal(computed.to_keeps[no_layer], loaded.to_keeps[no_layer])
+        np.testing.assert_array_equal(computed.aggregate_adjs[no_layer], loaded.aggregate_adjs[no_layer])
+
+
+def test_hierarchy_cache_not_writable(tmpdir):
+    # A file where the cache directory should be: the hierarchy is still computed, only not saved.
+    not_a_dir = tmpdir.join('file')
+    not_a_dir.write('')
+    aggregation = AggregationGraph(GRAPHS['grid'], 2, cluster_type='grid', processed_dir=str(not_a_dir))
+    assert len(aggregation.to_keeps) == 2
+
+
+def check_matching(adj, ids, nodes):
+    adj = scipy.sparse.coo_matrix(adj)
+    clusters, sizes = np.unique(ids, return_counts=True)
+    assert sizes.max() <= 2
+    assert (ids[~nodes] == np.arange(len(ids))[~nodes]).all()  # The masked nodes stay alone.
+
+    # Paired nodes are neighbours, and no edge is left between two unmatched nodes.
+    alone = np.in1d(ids, clusters[sizes == 1])
+    for i in np.where(~alone)[0]:
+        j = np.where(ids == ids[i])[0].sum() - i
+        assert adj.tocsr()[i, j] != 0
+    free = alone & nodes
+    assert not (free[adj.row] & free[adj.col] & (adj.row != adj.col)).any()
+
+
+@pytest.mark.parametrize('graph', sorted(GRAPHS))
+def test_heavy_edge_matching(graph):
+    adj = GRAPHS[graph]
+    nodes = np.random.RandomState(0).rand(adj.shape[0]) < 0.8
+    check_matching(adj, heavy_edge_matching(adj, nodes=nodes), nodes)
+
+
+def test_heavy_edge_matching_increasing_path():
+    # A path with increasing weights: the mutual proposals only matched one pair per round here, O(N^2) in total.
+    nb_nodes = 20000
+    weights = np.arange(1, nb_nodes, dtype=float)
+    adj = scipy.sparse.diags([weights, weights], [1, -1], shape=(nb_nodes, nb_nodes), format='csr')
+    nodes = np.ones(nb_nodes, dtype=bool)
+
+    start = time.time()
+    ids = heavy_edge_matching(adj, nodes=nodes)
+    assert time.time() - start < 2.
+    assert len(np.unique(ids)) == nb_nodes / 2
+    check_matching(adj[:200, :200], ids[:200], nodes[:200])
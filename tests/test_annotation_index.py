@@ -0,0 +1,44 @@
+import numpy
+
+from colombos_load_data import AnnotationIndex
+
+
+def test_row_lookup(tmpdir):
+    contrasts = numpy.array(['c%03d' % i for i in numpy.random.RandomState(0).permutation(300)])
+    pairs = numpy.array([list(contrasts[::3]) + ['extra'], ['cond%d' % (i % 7) for i in range(101)]])
+    index = AnnotationIndex.from_pairs(contrasts, pairs)
+
+    for i, contrast in enumerate(contrasts):
+        assert index.row(contrast) == i
+    assert index.row('extra') == len(contrasts)
+    assert index.row('a') is None and index.row('zzz') is None
+
+    assert index[contrasts[0]] == {'cond0'}
+    assert contrasts[1] not in index
+
+    index.save(str(tmpdir.join('annot')))
+    loaded = AnnotationIndex.load(str(tmpdir.join('annot')))
+    assert [loaded.row(contrast) for contrast in contrasts[:20]] == range(20)
+
+
+def test_contrasts_with():
+    contrasts = numpy.array(['c3', 'c0', 'c2', 'c1'])
+    pairs = numpy.array([['c0', 'c1', 'c1', 'c3', 'extra'], ['heat', 'heat', 'cold', 'ph', 'cold']])
+    index = AnnotationIndex.from_pairs(contrasts, pairs)
+
+    assert list(index.contrasts_with('heat')) == [1, 3]
+    assert list(index.contrasts_with(['cold', 'ph'])) == [0, 3, 4]
+    assert list(index.contrasts_with(['heat', 'heat', 'cold'])) == [1, 3, 4]
+    assert list(index.condition_ids(['aaa', 'cold', 'zzz'])) == [-1, 0, -1]
+    assert len(index.contrasts_with(['aaa', 'zzz'])) == 0
+    assert len(index.contrasts_with([])) == 0
+
+
+def test_empty_index():
+    index = AnnotationIndex.from_pairs(['c0', 'c1'], numpy.zeros((2, 0), dtype=str))
+
+    assert index.incidence.shape == (2, 0)
+    assert list(index.condition_ids(['heat', 'cold'])) == [-1, -1]
+    assert len(index.contrasts_with('heat')) == 0
+    assert index.row('c1') == 1
+    assert 'c0' not in index
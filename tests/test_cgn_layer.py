@@ -0,0 +1,34 @@
+import numpy as np
+import scipy.sparse
+import torch
+
+from models.graphLayer import CGNLayer
+
+
+def random_adj(nb_nodes=50, density=0.1):
+    return scipy.sparse.random(nb_nodes, nb_nodes, density=density, random_state=0, dtype=np.float32)
+
+
+def test_forward_matches_dense():
+    adj = random_adj()
+    layer = CGNLayer(adj, in_dim=3, channels=8)
+    x = torch.randn(4, 50, 3)
+
+    dense = torch.FloatTensor(adj.toarray())
+    weight, eye_weight = layer.linear.weight.squeeze(-1), layer.eye_linear.weight.squeeze(-1)
+    expected = torch.cat([torch.matmul(dense, x).matmul(weight.t()) + layer.linear.bias,
+                          x.matmul(eye_weight.t()) + layer.eye_linear.bias], dim=2)
+    np.testing.assert_allclose(layer(x).detach().numpy(), expected.detach().numpy(), atol=1e-5)
+
+
+def test_precomputed_is_single_branch():
+    # The input is A^k x, there is no raw x left for an eye branch.
+    layer = CGNLayer(random_adj(), in_dim=3, channels=8, precomputed=True)
+    assert layer.eye_linear is None
+    assert sorted(name for name, _ in layer.named_parameters()) == ['linear.bias', 'linear.weight']
+
+    x = torch.randn(4, 50, 3)
+    out = layer(x)
+    assert out.size() == (4, 50, 8)
+    expected = x.matmul(layer.linear.weight.squeeze(-1).t()) + layer.linear.bias
+    np.testing.assert_allclose(out.detach().numpy(), expected.detach().numpy(), atol=1e-6)
@@ -0,0 +1,143 @@
+import os
+import hashlib
+import zipfile
+import numpy
+import pytest
+
+import colombos_load_data
+from colombos_load_data import convert, load, load_cache
+
+
+CONTRASTS = ['c1', 'c2', 'c3']
+
+
+def write_compendium(directory):
+    # The three text files of a Colombos compendium, with 4 genes.
+    rng = numpy.random.RandomState(0)
+    with open(str(directory.join('exprdata.txt')), 'w') as f:
+        f.write('\t'.join(['Contrast'] + CONTRASTS) + '\n')
+        f.write('header\n' * 5)
+        f.write('\t'.join(['Locustag', 'Gene name', 'Entrez'] + CONTRASTS) + '\n')
+        for gene in range(4):
+            f.write('\t'.join(['b{}'.format(gene), 'g{}'.format(gene), str(gene)] +
+                              ['%.3f' % value for value in rng.randn(len(CONTRASTS))]) + '\n')
+    for name, pairs in [('refannot', [('c1', 'ref'), ('c3', 'ref')]), ('testannot', [('c2', 'heat'), ('c4', 'cold')])]:
+        with open(str(directory.join(name + '.txt')), 'w') as f:
+            f.write('Contrast\tCondition\n')
+            for pair in pairs:
+                f.write('\t'.join(pair) + '\n')
+
+
+def run_convert(directory, cache_dir):
+    files = [open(str(directory.join(name + '.txt'))) for name in ['exprdata', 'refannot', 'testannot']]
+    try:
+        convert(files[0], files[1], files[2], cache_dir)
+    finally:
+        for f in files:
+            f.close()
+
+
+def test_convert(tmpdir):
+    write_compendium(tmpdir)
+    cache_dir = str(tmpdir.join('cache'))
+    run_convert(tmpdir, cache_dir)
+
+    expressions, contrasts, genes, refannot, testannot = load_cache(cache_dir)
+    assert expressions.shape == (3, 4)
+    assert list(contrasts) == CONTRASTS
+    assert list(genes) == ['g0', 'g1', 'g2', 'g3']
+    numpy.testing.assert_allclose(expressions.mean(0), 0., atol=1e-6)
+    assert refannot['c1'] == {'ref'} and testannot['c4'] == {'cold'}
+
+
+def test_convert_twice(tmpdir):
+    write_compendium(tmpdir)
+    cache_dir = str(tmpdir.join('cache'))
+    run_convert(tmpdir, cache_dir)
+    first = os.stat(cache_dir + '/expressions.npy').st_mtime
+
+    # A second conversion, e.g. another job, keeps the first cache and leaves nothing behind.
+    run_convert(tmpdir, cache_dir)
+    assert sorted(os.listdir(str(tmpdir))) == ['cache', 'exprdata.txt', 'refannot.txt', 'testannot.txt']
+    assert os.stat(cache_dir + '/expressions.npy').st_mtime == first
+    assert load_cache(cache_dir)[0].shape == (3, 4)
+
+
+def test_convert_failure_cleans_up(tmpdir):
+    write_compendium(tmpdir)
+    with open(str(tmpdir.join('refannot.txt')), 'a') as f:
+        f.write('c1\tref\textra\n')  # Not pairs anymore.
+    with pytest.raises(ValueError):
+        run_convert(tmpdir, str(tmpdir.join('cache')))
+    assert sorted(os.listdir(str(tmpdir))) == ['exprdata.txt', 'refannot.txt', 'testannot.txt']
+
+
+def write_zip(directory, checksum=True):
+    # The compendium zip as it is downloaded, with a <zip>.sha256 next to it.
+    zippath = str(directory.join('ecoli_compendium_data.zip'))
+    with zipfile.ZipFile(zippath, 'w') as fh:
+        for kind in ['exprdata', 'refannot', 'testannot']:
+            fh.write(str(directory.join(kind + '.txt')), 'colombos_ecoli_{}_2017.txt'.format(kind))
+    if checksum:
+        with open(zippath, 'rb') as f:
+            digest = hashlib.sha256(f.read()).hexdigest()
+        with open(zippath + '.sha256', 'w') as f:
+            f.write(digest + '  ecoli_compendium_data.zip\n')
+    return zippath
+
+
+def test_load_from_mirror(tmpdir):
+    mirror = tmpdir.mkdir('mirror')
+    write_compendium(mirror)
+    write_zip(mirror)
+    data_dir = str(tmpdir.join('data'))
+    expressions, contrasts, genes, refannot, testannot = load('ecoli', shared=False, data_dir=data_dir,
+                                                              mirror_dir=str(mirror), offline=True)
+    assert expressions.shape == (3, 4)
+    assert list(genes) == ['g0', 'g1', 'g2', 'g3']
+    assert refannot['c3'] == {'ref'}
+
+
+def test_load_mirror_needs_checksum(tmpdir):
+    mirror = tmpdir.mkdir('mirror')
+    write_compendium(mirror)
+    write_zip(mirror, checksum=False)
+    with pytest.raises(IOError):
+        load('ecoli', shared=False, data_dir=str(tmpdir.join('data')), mirror_dir=str(mirror), offline=True)
+    assert not os.listdir(str(tmpdir.join('data')))
+
+
+def test_load_bad_checksum(tmpdir):
+    mirror = tmpdir.mkdir('mirror')
+    write_compendium(mirror)
+    zippath = write_zip(mirror)
+    with open(zippath + '.sha256', 'w') as f:
+        f.write('0' * 64 + '  ecoli_compendium_data.zip\n')
+    with pytest.raises(IOError):
+        load('ecoli', shared=False, data_dir=str(tmpdir.join('data')), mirror_dir=str(mirror), offline=True)
+
+
+def test_load_without_checksum_warns(tmpdir, caplog):
+    data_dir = tmpdir.mkdir('data')
+    write_compendium(data_dir)
+    write_zip(data_dir, checksum=False)
+    expressions = load('ecoli', shared=False, data_dir=str(data_dir), offline=True)[0]
+    assert expressions.shape == (3, 4)
+    assert 'sha256' in caplog.text
+
+
+def test_load_changed_zip(tmpdir):
+    mirror = tmpdir.mkdir('mirror')
+    data_dir = str(tmpdir.join('data'))
+    write_compendium(mirror)
+    write_zip(mirror)
+    first = load('ecoli', shared=False, data_dir=data_dir, mirror_dir=str(mirror), offline=True)[0]
+
+    # A new release of the compendium gets its own cache instead of the old one.
+    with open(str(mirror.join('exprdata.txt')), 'a') as f:
+        f.write('\t'.join(['b4', 'g4', '4', '1.0', '2.0', '3.0']) + '\n')
+    write_zip(mirror)
+
+    second = load('ecoli', shared=False, data_dir=data_dir, mirror_dir=str(mirror), offline=True)[0]
+    assert first.shape == (3, 4) and second.shape == (3, 5)
+    assert len(os.listdir(data_dir)) == 2
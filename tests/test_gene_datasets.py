@@ -0,0 +1,146 @@
+import h5py
+import numpy as np
+import pytest
+
+import gene_datasets
+from graph import Graph
+
+
+def write_dataset(path, nb_examples=20, nb_genes=5010, seed=0):
+    rng = np.random.RandomState(seed)
+    with h5py.File(str(path), 'w') as f:
+        f['expression_data'] = rng.rand(nb_examples, nb_genes).astype(np.float32)
+        f['labels_data'] = rng.randint(0, 3, nb_examples)
+        f['gene_names'] = np.array(['gene_{}'.format(i) for i in range(nb_genes)])
+
+
+def gene_inference(tmpdir, **kwargs):
+    np.random.seed(0)  # The genes to keep and to infer are shuffled.
+    return gene_datasets.TCGAGeneInference(data_dir=str(tmpdir), data_file='data.hdf5', **kwargs)
+
+
+@pytest.mark.parametrize('nb_master_nodes', [0, 2])
+def test_lazy_gene_inference(tmpdir, nb_master_nodes):
+    write_dataset(tmpdir.join('data.hdf5'))
+    dataset = gene_inference(tmpdir, nb_master_nodes=nb_master_nodes)
+    lazy = gene_inference(tmpdir, nb_master_nodes=nb_master_nodes, lazy=True)
+
+    assert lazy.data.shape == dataset.data.shape == (20, 5000)
+    assert list(lazy.node_names) == list(dataset.node_names)
+    np.testing.assert_allclose(lazy.data[np.arange(20)], dataset.data, atol=1e-5)
+
+    idx = [3, 1, 7]
+    batch, lazy_batch = dataset.get_batch(idx), lazy.get_batch(idx)
+    np.testing.assert_allclose(lazy_batch['sample'].numpy(), batch['sample'].numpy(), atol=1e-5)
+    np.testing.assert_allclose(lazy_batch['labels'].numpy(), batch['labels'].numpy(), atol=1e-5)
+    np.testing.assert_allclose(lazy[5]['sample'], dataset[5]['sample'], atol=1e-5)
+
+
+def test_lazy_select_columns():
+    source = np.arange(24, dtype=np.float32).reshape(4, 6)
+    data = gene_datasets.LazyExpression(source)
+    data.add_master_nodes(1)
+    centered = np.concatenate([np.ones((4, 1)), source - source.mean(0)], axis=1)
+
+    view = data.select_columns(slice(1, 5)).select_columns([0, 2])
+    assert view.shape == (4, 2)
+    np.testing.assert_allclose(view[np.arange(4)], centered[:, 1:5][:, [0, 2]])
+    np.testing.assert_allclose(view[2], centered[2, 1:5][[0, 2]])
+    assert data.shape == (4, 7)
+
+
+def test_lazy_for_label_fails(tmpdir):
+    with pytest.raises(ValueError):
+        gene_datasets.TCGAForLabel(data_dir=str(tmpdir), lazy=True)
+
+
+def test_lazy_intersection_fails(tmpdir):
+    write_dataset(tmpdir.join('data.hdf5'), nb_genes=10)
+    dataset = gene_datasets.GeneDataset(data_dir=str(tmpdir), data_file='data.hdf5', name='test', lazy=True)
+    graph = Graph()
+    graph.adj = np.eye(10)
+    graph.set_node_names(['gene_{}'.format(i) for i in range(10)])
+    with pytest.raises(ValueError):
+        graph.intersection_with(dataset)
+
+
+def test_getitem_leaves_data_unchanged(tmpdir):
+    write_dataset(tmpdir.join('data.hdf5'))
+    dataset = gene_inference(tmpdir)
+    data = dataset.data.copy()
+
+    item = dataset[4]
+    np.testing.assert_array_equal(dataset.data, data)
+    np.testing.assert_allclose(item['sample'][dataset.gene_to_keep, 0], data[4, dataset.gene_to_keep] + 1e-8)
+    np.testing.assert_allclose(item['labels'][dataset.gene_to_infer], data[4, dataset.gene_to_infer] + 1e-8)
+
+
+@pytest.mark.parametrize('lazy', [False, True])
+def test_precomputed_matches_masking(tmpdir, lazy):
+    write_dataset(tmpdir.join('data.hdf5'))
+    dataset = gene_inference(tmpdir, lazy=lazy)
+    precomputed = gene_inference(tmpdir, lazy=lazy, precomputed_dir=str(tmpdir.join('cache')))
+    assert precomputed.precomputed is None  # Only built when needed.
+
+    idx = [3, 1, 7]
+    for key in ['sample', 'labels']:
+        np.testing.assert_array_equal(precomputed.get_batch(idx)[key].numpy(), dataset.get_batch(idx)[key].numpy())
+        np.testing.assert_array_equal(precomputed[5][key], dataset[5][key])
+
+
+def test_precomputed_key_follows_content(tmpdir):
+    # Same shape, same genes to keep and to infer, different data.
+    write_dataset(tmpdir.join('data.hdf5'), seed=0)
+    write_dataset(tmpdir.join('other.hdf5'), seed=1)
+    cache = tmpdir.join('cache')
+
+    first = gene_inference(tmpdir, precomputed_dir=str(cache))
+    first.get_batch([0])
+    np.random.seed(0)
+    other = gene_datasets.TCGAGeneInference(data_dir=str(tmpdir), data_file='other.hdf5', precomputed_dir=str(cache))
+    other.get_batch([0])
+    assert len(cache.listdir('*-inputs.npy')) == 2
+
+    # Same file, data changed after the fact.
+    first.data = first.data * 2.
+    np.testing.assert_allclose(first.get_batch([2])['labels'].numpy()[0, first.gene_to_infer],
+                               first.data[2, first.gene_to_infer] + 1e-8, rtol=1e-6)
+    assert len(cache.listdir('*-inputs.npy')) == 3
+
+
+def test_precomputed_rebuilt_when_data_replaced(tmpdir):
+    write_dataset(tmpdir.join('data.hdf5'))
+    dataset = gene_inference(tmpdir, precompute=True)
+    dataset.get_batch([0])
+
+    dataset.data = dataset.data[:10]
+    assert dataset.get_batch([9])['sample'].size(0) == 1
+    assert precomputed_shapes(dataset) == [(10, 5000, 1), (10, 5000)]
+
+
+def precomputed_shapes(dataset):
+    return [array.shape for array in gene_datasets.precomputed_arrays(dataset)]
+
+
+def test_stats_file_columns(tmpdir):
+    write_dataset(tmpdir.join('data.hdf5'), nb_genes=10)
+    write_dataset(tmpdir.join('other.hdf5'), nb_genes=12)
+    stats_file = str(tmpdir.join('stats.npz'))
+
+    gene_datasets.GeneDataset(data_dir=str(tmpdir), data_file='data.hdf5', name='test', stats_file=stats_file)
+    gene_datasets.GeneDataset(data_dir=str(tmpdir), data_file='data.hdf5', name='test', stats_file=stats_file, lazy=True)
+    for lazy in [False, True]:
+        with pytest.raises(ValueError):
+            gene_datasets.GeneDataset(data_dir=str(tmpdir), data_file='other.hdf5', name='test', stats_file=stats_file,
+                                      lazy=lazy)
+
+
+def test_centering_skips_nan(tmpdir):
+    write_dataset(tmpdir.join('data.hdf5'), nb_genes=10)
+    with h5py.File(str(tmpdir.join('data.hdf5')), 'a') as f:
+        data = f['expression_data'][:]
+        data[3, 4] = np.nan
+        f['expression_data'][...] = data
+    dataset = gene_datasets.GeneDataset(data_dir=str(tmpdir), data_file='data.hdf5', name='test')
+    assert np.isnan(dataset.data).sum() == 1
+    np.testing.assert_allclose(np.nanmean(dataset.data, 0), 0., atol=1e-6)
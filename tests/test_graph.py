@@ -0,0 +1,150 @@
+import h5py
+import numpy as np
+import pandas as pd
+import pytest
+import scipy.sparse
+
+import gene_datasets
+from graph import Graph, read_adj, convert_graph
+
+
+class Expressions(object):
+    # Just what intersection_with uses of a dataset.
+    def __init__(self, df):
+        self.df = df
+        self.node_names = df.columns.tolist()
+        self.data = df.values
+
+
+def legacy_intersection(graph_df, df):
+    # The DataFrame based alignment intersection_with used to do, as (adj, dataset df).
+    l = df.columns.tolist()
+    duplicates = set([x for x in l if l.count(x) > 1])
+    for dup in duplicates:
+        l.remove(dup)
+    df = df.groupby(lambda x: x, axis=1).mean()
+    df = df[l]
+
+    intersection = np.intersect1d(graph_df.columns.tolist(), df.columns.tolist())
+    graph_df = graph_df[intersection].filter(items=intersection, axis='index')
+    diff = np.setdiff1d(df.columns.tolist(), intersection)
+    zeros = pd.DataFrame(0, index=diff.tolist(), columns=diff.tolist())
+    graph_df = pd.concat([graph_df, zeros]).fillna(0.)
+    graph_df = graph_df[l].loc[l]
+    return graph_df.values, df
+
+
+def legacy_add_master_nodes(graph_df, nb_master_nodes):
+    master = ['master_{}'.format(i) for i in range(nb_master_nodes)]
+    return pd.concat([graph_df, pd.DataFrame(1., index=master, columns=master)]).fillna(1.)
+
+
+def random_graph(names, seed=0):
+    rng = np.random.RandomState(seed)
+    adj = (rng.rand(len(names), len(names)) < 0.3) * rng.rand(len(names), len(names))
+    adj = np.maximum(adj, adj.T)
+    graph = Graph()
+    graph.adj = adj
+    graph.set_node_names(list(names))
+    return graph, pd.DataFrame(adj, index=names, columns=names)
+
+
+def dataset_with(columns, seed=1):
+    rng = np.random.RandomState(seed)
+    return Expressions(pd.DataFrame(rng.rand(6, len(columns)), columns=columns))
+
+
+@pytest.mark.parametrize('nb_master_nodes', [0, 2])
+@pytest.mark.parametrize('sparse', [False, True])
+def test_intersection_matches_legacy(nb_master_nodes, sparse):
+    graph_names = ['g{}'.format(i) for i in range(12)]
+    graph, graph_df = random_graph(graph_names)
+    if sparse:
+        graph.adj = scipy.sparse.csr_matrix(graph.adj)
+
+    # Shuffled, with genes missing from the graph and some of them there twice.
+    columns = ['g7', 'x1', 'g3', 'g0', 'g3', 'g11', 'x0', 'g5', 'x1', 'g9', 'g2', 'g7']
+    master_names = ['master_{}'.format(i) for i in reversed(range(nb_master_nodes))]
+    dataset = dataset_with(master_names + columns)
+
+    graph.add_master_nodes(nb_master_nodes)
+    expected_adj, expected_df = legacy_intersection(legacy_add_master_nodes(graph_df, nb_master_nodes), dataset.df)
+    graph.intersection_with(dataset)
+
+    assert dataset.node_names == expected_df.columns.tolist()
+    assert list(graph.node_names) == dataset.node_names
+    assert len(set(dataset.node_names)) == len(dataset.node_names)
+    np.testing.assert_allclose(dataset.data, expected_df.values)
+    assert scipy.sparse.issparse(graph.adj)
+    np.testing.assert_allclose(graph.adj.toarray(), expected_adj)
+
+
+def test_intersection_without_common_genes():
+    graph, _ = random_graph(['g{}'.format(i) for i in range(5)])
+    dataset = dataset_with(['x0', 'x1', 'x2'])
+    graph.intersection_with(dataset)
+    assert graph.adj.shape == (3, 3) and graph.adj.nnz == 0
+    assert list(graph.node_names) == ['x0', 'x1', 'x2']
+
+
+def test_duplicate_graph_names():
+    # The first of the nodes with the same name is the one kept.
+    graph, _ = random_graph(['g0', 'g1', 'g0', 'g2'])
+    adj = graph.adj.copy()
+    graph.intersection_with(dataset_with(['g2', 'g0']))
+    np.testing.assert_allclose(graph.adj.toarray(), adj[np.ix_([3, 0], [3, 0])])
+
+
+@pytest.mark.parametrize('sparse', [False, True])
+def test_add_master_nodes(sparse):
+    graph_names = ['g{}'.format(i) for i in range(6)]
+    graph, graph_df = random_graph(graph_names)
+    if sparse:
+        graph.adj = scipy.sparse.csr_matrix(graph.adj)
+    graph.add_master_nodes(3)
+
+    names = ['master_2', 'master_1', 'master_0'] + graph_names
+    assert list(graph.node_names) == names
+    assert list(graph.node_index[names]) == range(9)
+    assert scipy.sparse.issparse(graph.adj) == sparse
+
+    adj = graph.adj.toarray() if sparse else graph.adj
+    expected = legacy_add_master_nodes(graph_df, 3)
+    np.testing.assert_allclose(adj, expected.loc[names, names].values)
+
+    # Same order as the 'master_{i}' columns Dataset inserts in front of the genes.
+    df = pd.DataFrame(np.zeros((2, 6)), columns=graph_names)
+    for master in range(3):
+        df.insert(0, 'master_{}'.format(master), 1.)
+    assert df.columns.tolist() == names
+
+    graph.add_master_nodes(0)
+    assert list(graph.node_names) == names
+
+
+# Blocks of 3 rows, so less than the nnz and than the nodes, or all of it in one block.
+@pytest.mark.parametrize('chunk_size', [3, 1024])
+def test_convert_graph_round_trip(tmpdir, chunk_size):
+    names = np.array(['g{}'.format(i) for i in range(10)])
+    _, graph_df = random_graph(names)
+    adj = graph_df.values.astype(np.float32)
+    adj[4] = adj[:, 4] = 0.  # A node without edges.
+    dense_path, sparse_path = str(tmpdir.join('dense.hdf5')), str(tmpdir.join('sparse.hdf5'))
+    with h5py.File(dense_path, 'w') as f:
+        f['graph_data'] = adj
+        f['gene_names'] = names
+
+    convert_graph(dense_path, sparse_path, chunk_size=chunk_size)
+    with h5py.File(sparse_path, 'r') as f:
+        assert 'graph_data' not in f
+        sparse_adj = read_adj(f)
+    assert sparse_adj.dtype == np.float32 and sparse_adj.nnz == (adj != 0).sum()
+    np.testing.assert_array_equal(sparse_adj.toarray(), adj)
+
+    for path in [dense_path, sparse_path]:
+        graph = Graph()
+        graph.load_graph(path)
+        assert scipy.sparse.isspmatrix_csr(graph.adj)
+        np.testing.assert_array_equal(graph.adj.toarray(), adj)
+        assert list(graph.node_names) == list(names)
+        assert graph.node_index['g7'] == 7
@@ -0,0 +1,56 @@
+import numpy as np
+import scipy.sparse
+import pytest
+
+from models.graphLayer import hash_adj, ApprNormalizeLaplacian
+
+
+def same_repr_graphs(nb_nodes=1100):
+    # Big enough for numpy to only print the corners, and different in the middle.
+    rng = np.random.RandomState(0)
+    adj = (rng.rand(nb_nodes, nb_nodes) < 0.01).astype(float)
+    adj = np.maximum(adj, adj.T)
+    other = adj.copy()
+    middle = nb_nodes // 2
+    other[middle, middle + 1] = other[middle + 1, middle] = 1. - adj[middle, middle + 1]
+    return adj, other
+
+
+def test_same_repr_different_hash():
+    adj, other = same_repr_graphs()
+    assert str(adj) == str(other)
+    assert hash_adj(adj) != hash_adj(other)
+
+
+def test_same_repr_different_cache_files(tmpdir):
+    adj, other = same_repr_graphs()
+    transform = ApprNormalizeLaplacian(processed_dir=str(tmpdir), processed_file='graph')
+
+    norm_adj = transform(adj.copy())
+    norm_other = transform(other.copy())
+    assert not np.allclose(norm_adj, norm_other)
+
+    assert len(list(tmpdir.visit('graph*.npy'))) == 2
+
+    # And each graph gets back its own normalization.
+    np.testing.assert_array_equal(transform(adj.copy()), norm_adj)
+    np.testing.assert_array_equal(transform(other.copy()), norm_other)
+    assert len(list(tmpdir.visit('graph*.npy'))) == 2
+
+
+@pytest.mark.parametrize('chunk_size', [1, 100, 4096, 2 ** 30])
+def test_hash_independent_of_chunk_size_and_order(chunk_size):
+    adj, _ = same_repr_graphs(300)
+    expected = hash_adj(adj)
+    assert hash_adj(adj, chunk_size=chunk_size) == expected
+    assert hash_adj(np.asfortranarray(adj), chunk_size=chunk_size) == expected
+
+    sparse = scipy.sparse.csr_matrix(adj)
+    assert hash_adj(sparse, chunk_size=chunk_size) == hash_adj(sparse)
+    assert hash_adj(sparse.tocsc(), chunk_size=chunk_size) == hash_adj(sparse)
+
+
+def test_hash_depends_on_dtype_and_args():
+    adj, _ = same_repr_graphs(300)
+    assert hash_adj(adj) != hash_adj(adj.astype(np.float32))
+    assert hash_adj(adj, 2, 'grid') != hash_adj(adj, 3, 'grid')
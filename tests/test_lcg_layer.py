@@ -0,0 +1,123 @@
+import numpy as np
+import scipy.sparse
+import torch
+import pytest
+
+from models.graphLayer import LCGLayer
+
+
+def legacy_edges(adj, max_edges):
+    # The per row np.where padding LCGLayer.init_params used before it read the CSR arrays.
+    adj = np.asarray(adj)
+    nb_nodes = adj.shape[0]
+    edges_np = [np.asarray(np.where(adj[i:i + 1] > 0.)).T for i in range(len(adj))]
+    edges_np = [np.concatenate([x, [[0, nb_nodes]] * (max_edges - len(x))]) if len(x) < max_edges
+                else x[:max_edges] if len(x) > max_edges
+                else x
+                for i, x in enumerate(edges_np)]
+    for i in range(len(edges_np)):
+        edges_np[i][:, 0] = i
+    edges_np = np.array(edges_np).reshape(-1, 2)
+    return torch.LongTensor(edges_np[:, 1:2])
+
+
+def random_graph(nb_nodes=80, density=0.05, symmetric=True, seed=0):
+    rng = np.random.RandomState(seed)
+    adj = (rng.rand(nb_nodes, nb_nodes) < density) * rng.rand(nb_nodes, nb_nodes)
+    if symmetric:
+        adj = np.maximum(adj, adj.T)
+    adj[0] = 0.  # A node without edges.
+    if symmetric:
+        adj[:, 0] = 0.
+    return adj
+
+
+def grid_graph(size=8):
+    nb_nodes = size * size
+    adj = np.zeros((nb_nodes, nb_nodes))
+    for node in range(nb_nodes):
+        if node % size < size - 1:
+            adj[node, node + 1] = adj[node + 1, node] = 1.
+        if node + size < nb_nodes:
+            adj[node, node + size] = adj[node + size, node] = 1.
+    return adj
+
+
+INPUTS = {
+    'dense': lambda adj: adj,
+    'matrix': lambda adj: np.matrix(adj),
+    'sparse': lambda adj: scipy.sparse.csr_matrix(adj),
+}
+
+
+@pytest.mark.parametrize('graph', [random_graph(), random_graph(seed=1, density=0.2), grid_graph()])
+@pytest.mark.parametrize('kind', sorted(INPUTS))
+def test_edges_unchanged(graph, kind):
+    # Symmetric graphs, where the max row degree the default pads to is the old max column degree.
+    max_degree = (graph > 0).sum(1).max()
+    layer = LCGLayer(INPUTS[kind](graph.copy()))
+    assert layer.max_edges == max_degree
+    assert torch.equal(layer.edges, legacy_edges(graph, max_degree))
+
+
+@pytest.mark.parametrize('symmetric', [True, False])
+@pytest.mark.parametrize('kind', sorted(INPUTS))
+def test_edges_truncated(symmetric, kind):
+    graph = random_graph(density=0.2, symmetric=symmetric, seed=2)
+    max_edges = 5
+    assert ((graph > 0).sum(1) > max_edges).any()
+    layer = LCGLayer(INPUTS[kind](graph.copy()), max_edges=max_edges)
+    assert torch.equal(layer.edges, legacy_edges(graph, max_edges))
+
+
+def test_default_pads_to_row_degree():
+    graph = random_graph(density=0.1, symmetric=False, seed=3)
+    graph[1] = 1.  # One row with every edge, more than any column.
+    layer = LCGLayer(graph.copy())
+    assert layer.max_edges == graph.shape[0]
+    assert torch.equal(layer.edges, legacy_edges(graph, graph.shape[0]))
+
+
+def slot_nodes(layer):
+    # The node each edge slot belongs to.
+    widths = np.concatenate([[width] * nb_rows for nb_rows, width in layer.buckets] + [np.zeros((0,), dtype=int)])
+    if layer.bucketed:
+        order = np.argsort(layer.position.numpy(), kind='mergesort')[:len(widths)]
+    else:
+        order = np.arange(len(widths))
+    return np.repeat(order, widths.astype(int))
+
+
+def set_weights(layer, weights):
+    # weights[node, neighbour] for each slot, the padding slots point to the filler node.
+    layer.my_weights.data = torch.FloatTensor(weights[slot_nodes(layer), layer.edges.numpy()[:, 0]])
+
+
+@pytest.mark.parametrize('max_edges', [None, 5])
+def test_bucketed_forward_matches_padded(max_edges):
+    graph = random_graph(density=0.2, symmetric=False, seed=4)
+    in_dim, channels = 3, 2
+    weights = np.random.RandomState(0).randn(graph.shape[0], graph.shape[0] + 1, in_dim, channels)
+    x = torch.randn(4, graph.shape[0], in_dim)
+
+    padded = LCGLayer(graph.copy(), max_edges=max_edges, in_dim=in_dim, channels=channels)
+    bucketed = LCGLayer(graph.copy(), max_edges=max_edges, bucketed=True, in_dim=in_dim, channels=channels)
+    set_weights(padded, weights)
+    set_weights(bucketed, weights)
+
+    expected = padded(x)
+    np.testing.assert_allclose(bucketed(x).detach().numpy(), expected.detach().numpy(), rtol=1e-5, atol=1e-5)
+
+    if max_edges is None:
+        # And both are sum_j A_ij x_j W_ij.
+        dense = np.einsum('ij,bjk,ijkc->bic', (graph > 0).astype(float), x.numpy(), weights[:, :-1])
+        np.testing.assert_allclose(expected.detach().numpy(), dense, rtol=1e-4, atol=1e-4)
+
+
+@pytest.mark.parametrize('bucketed', [False, True])
+@pytest.mark.parametrize('max_edges', [None, 4])
+def test_no_edges(max_edges, bucketed):
+    layer = LCGLayer(np.zeros((6, 6)), max_edges=max_edges, bucketed=bucketed, channels=2)
+    out = layer(torch.randn(3, 6, 1))
+    assert out.size() == (3, 6, 2)
+    assert (out == 0).all()
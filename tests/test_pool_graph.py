@@ -0,0 +1,56 @@
+import numpy as np
+import torch
+import pytest
+
+from models.graphLayer import PoolGraph
+
+
+def legacy_pool(x, adj, to_keep, type):
+    # PoolGraph.__call__ before the segment reduction: a dense (ex * channel, node, node) masked product.
+    adj = torch.FloatTensor(adj)
+    to_keep = torch.FloatTensor(to_keep.astype(float))
+
+    x = x.permute(0, 2, 1).contiguous()  # put in ex, channel, node
+    x_shape = x.size()
+
+    if type == 'max':
+        max_value = (x.view(-1, x.size(-1), 1) * adj).max(dim=1)[0]
+    elif type == 'mean':
+        max_value = (x.view(-1, x.size(-1), 1) * adj).mean(dim=1)
+    elif type == 'strip':
+        max_value = x.view(-1, x.size(-1))
+
+    retn = max_value * to_keep
+    return retn.view(x_shape).permute(0, 2, 1).contiguous()
+
+
+def uneven_graph(nb_nodes=40, seed=0):
+    # Columns (clusters) of every degree: empty, a single edge, a few, many and full, with weights.
+    rng = np.random.RandomState(seed)
+    adj = np.zeros((nb_nodes, nb_nodes))
+    for node in range(nb_nodes):
+        degree = [0, 1, 3, nb_nodes // 2, nb_nodes][node % 5]
+        adj[rng.permutation(nb_nodes)[:degree], node] = rng.rand(degree) + 0.5
+    return adj
+
+
+@pytest.mark.parametrize('type', ['max', 'mean', 'strip'])
+@pytest.mark.parametrize('nb_master_nodes', [0, 2])
+def test_pool_matches_dense(type, nb_master_nodes):
+    adj = uneven_graph()
+    assert (adj.sum(0) == 0).any()
+
+    rng = np.random.RandomState(1)
+    to_keep = (rng.rand(adj.shape[0]) < 0.5).astype(float)
+    to_keep[:nb_master_nodes] = 1.  # The master nodes are always kept.
+    x = torch.randn(3, adj.shape[0], 4)  # Negative values, so the 0. of the missing edges matter for the max.
+
+    expected = legacy_pool(x, adj, to_keep, type)
+    pooled = PoolGraph(adj, to_keep, type=type)(x)
+    np.testing.assert_allclose(pooled.numpy(), expected.numpy(), rtol=1e-5, atol=1e-6)
+
+
+def test_pool_keeps_everything():
+    adj = uneven_graph()
+    x = torch.randn(2, adj.shape[0], 3)
+    assert PoolGraph(adj, np.ones(adj.shape[0]))(x) is x
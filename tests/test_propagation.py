@@ -0,0 +1,67 @@
+import os
+import h5py
+import numpy as np
+import scipy.sparse
+import pytest
+
+import gene_datasets
+from propagation import propagate_expression, source_file
+
+
+def write_dataset(path, nb_examples=30, nb_genes=12, seed=0):
+    rng = np.random.RandomState(seed)
+    with h5py.File(str(path), 'w') as f:
+        f['expression_data'] = rng.rand(nb_examples, nb_genes).astype(np.float32)
+        f['labels_data'] = rng.randint(0, 3, nb_examples)
+        f['gene_names'] = np.array(['gene_{}'.format(i) for i in range(nb_genes)])
+    return rng
+
+
+def random_adj(nb_genes=12):
+    return scipy.sparse.random(nb_genes, nb_genes, density=0.3, random_state=1)
+
+
+@pytest.mark.parametrize('nb_examples', [None, 15])
+@pytest.mark.parametrize('nb_hops', [1, 2])
+def test_propagate_matches_dense(tmpdir, nb_examples, nb_hops):
+    write_dataset(tmpdir.join('data.hdf5'))
+    adj = random_adj()
+    propagated = propagate_expression(adj, str(tmpdir.join('data.hdf5')), str(tmpdir.join('out', 'propagated.npy')),
+                                      nb_hops=nb_hops, chunk_size=7, nb_examples=nb_examples)
+
+    with h5py.File(str(tmpdir.join('data.hdf5')), 'r') as f:
+        expected = np.array(f['expression_data'][:nb_examples], dtype=np.float64)
+    for _ in range(nb_hops):
+        expected = adj.dot(expected.T).T
+    np.testing.assert_allclose(propagated, expected, rtol=1e-5)
+    assert os.path.isfile(source_file(str(tmpdir.join('out', 'propagated.npy'))))
+
+
+def load(tmpdir, **kwargs):
+    dataset = gene_datasets.GeneDataset(data_dir=str(tmpdir), data_file='data.hdf5', name='test',
+                                        propagated_file=str(tmpdir.join('propagated.npy')), **kwargs)
+    dataset.file.close()  # So the test can rewrite it.
+    return dataset
+
+
+def test_load_checks_the_source(tmpdir):
+    write_dataset(tmpdir.join('data.hdf5'))
+    propagated = propagate_expression(random_adj(), str(tmpdir.join('data.hdf5')), str(tmpdir.join('propagated.npy')),
+                                      nb_examples=20)
+
+    dataset = load(tmpdir, nb_examples=20)
+    np.testing.assert_allclose(dataset.data, propagated - propagated.mean(0), atol=1e-5)
+    assert load(tmpdir, nb_examples=10, lazy=True).data.shape == (10, 12)
+
+    with pytest.raises(ValueError):
+        load(tmpdir)  # 30 examples in the data, only 20 propagated.
+
+    write_dataset(tmpdir.join('data.hdf5'), seed=1)  # Same shape, other data.
+    with pytest.raises(ValueError):
+        load(tmpdir, nb_examples=20)
+
+    write_dataset(tmpdir.join('data.hdf5'))
+    load(tmpdir, nb_examples=20)
+    os.remove(source_file(str(tmpdir.join('propagated.npy'))))
+    with pytest.raises(ValueError):
+        load(tmpdir, nb_examples=20)
@@ -0,0 +1,50 @@
+import numpy as np
+import torch
+from torch.autograd import gradcheck, gradgradcheck
+
+from models.graphLayer import SparseMM
+
+
+def sparse_matrix(nb_nodes=20, density=0.2, dtype=torch.float64):
+    rng = np.random.RandomState(0)
+    dense = (rng.rand(nb_nodes, nb_nodes) < density) * rng.rand(nb_nodes, nb_nodes)
+    edges = torch.LongTensor(np.array(np.where(dense)))
+    values = torch.tensor(dense[np.where(dense)], dtype=dtype)
+    return torch.sparse_coo_tensor(edges, values, (nb_nodes, nb_nodes)), dense
+
+
+def test_gradcheck():
+    sparse, _ = sparse_matrix()
+    x = torch.randn(20, 5, dtype=torch.float64, requires_grad=True)
+    assert gradcheck(lambda dense: SparseMM.apply(sparse, dense), (x,))
+
+
+def test_gradgradcheck():
+    sparse, _ = sparse_matrix()
+    x = torch.randn(20, 5, dtype=torch.float64, requires_grad=True)
+    # Squared, so the second derivative is not trivially 0.
+    assert gradgradcheck(lambda dense: SparseMM.apply(sparse, dense) ** 2, (x,))
+
+
+def test_float16_cpu():
+    sparse, dense = sparse_matrix(dtype=torch.float32)
+    x = torch.randn(20, 5).half().requires_grad_()
+
+    out = SparseMM.apply(sparse, x)
+    out.float().sum().backward()
+
+    assert out.dtype == torch.float16
+    assert x.grad.dtype == torch.float16
+    expected = np.dot(dense, x.detach().float().numpy())
+    np.testing.assert_allclose(out.detach().float().numpy(), expected, atol=1e-2, rtol=1e-2)
+    expected_grad = dense.sum(0)[:, None].repeat(5, axis=1)
+    np.testing.assert_allclose(x.grad.float().numpy(), expected_grad, atol=1e-2, rtol=1e-2)
+
+
+def test_float_matches_dense():
+    sparse, dense = sparse_matrix(dtype=torch.float32)
+    x = torch.randn(20, 5, requires_grad=True)
+    out = SparseMM.apply(sparse, x)
+    out.sum().backward()
+    np.testing.assert_allclose(out.detach().numpy(), np.dot(dense, x.detach().numpy()), atol=1e-5)
+    np.testing.assert_allclose(x.grad.numpy(), dense.sum(0)[:, None].repeat(5, axis=1), atol=1e-5)
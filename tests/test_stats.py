@@ -0,0 +1,66 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from stats import RunningStats
+
+
+def random_data(with_nan, seed=0):
+    rng = np.random.RandomState(seed)
+    data = rng.randn(103, 7) * 5. + 1000.  # A big offset, where sum(x^2) - sum(x)^2 cancels.
+    if with_nan:
+        data[rng.rand(*data.shape) < 0.2] = np.nan
+        data[:60, 2] = np.nan  # Some chunks without any value in that column.
+        data[:, 5] = np.nan  # A column without any value.
+    return data
+
+
+@pytest.mark.parametrize('chunk_size', [1, 10, 17, 103, 500])
+@pytest.mark.parametrize('with_nan', [False, True])
+def test_fit_matches_numpy(chunk_size, with_nan):
+    data = random_data(with_nan)
+    stats = RunningStats().fit(data, chunk_size=chunk_size)
+
+    with np.errstate(invalid='ignore'), pytest.warns(None):
+        expected_mean, expected_var = np.nanmean(data, 0), np.nanvar(data, 0)
+    np.testing.assert_allclose(stats.mean, expected_mean, rtol=1e-12)
+    np.testing.assert_allclose(stats.variance, expected_var, rtol=1e-9)
+    np.testing.assert_array_equal(stats.count, (~np.isnan(data)).sum(0))
+
+    # And it centers as pandas did, skipping the NaN.
+    df = pd.DataFrame(data)
+    np.testing.assert_allclose((df - stats.mean).values, (df - df.mean(0)).values, atol=1e-9)
+
+
+def test_uneven_chunks():
+    data = random_data(True)
+    stats = RunningStats()
+    for start, end in [(0, 3), (3, 50), (50, 51), (51, 51), (51, 103)]:
+        stats.update(data[start:end])
+    reference = RunningStats().fit(data, chunk_size=103)
+    np.testing.assert_allclose(stats.mean, reference.mean, rtol=1e-12)
+    np.testing.assert_allclose(stats.variance, reference.variance, rtol=1e-9)
+
+
+def test_standardize_and_save(tmpdir):
+    data = random_data(True)
+    stats = RunningStats().fit(data, chunk_size=10)
+    stats.save(str(tmpdir.join('stats.npz')))
+    loaded = RunningStats.load(str(tmpdir.join('stats.npz')))
+    np.testing.assert_array_equal(loaded.count, stats.count)
+    np.testing.assert_array_equal(loaded.mean, stats.mean)
+
+    standardized = loaded.standardize(data.copy(), chunk_size=10)
+    with np.errstate(invalid='ignore'), pytest.warns(None):
+        expected = (data - np.nanmean(data, 0)) / np.nanstd(data, 0)
+    np.testing.assert_allclose(standardized[:, [0, 1, 2, 3, 4, 6]], expected[:, [0, 1, 2, 3, 4, 6]], atol=1e-9)
+    assert np.isnan(standardized[:, 5]).all()
+
+
+def test_load_single_count(tmpdir):
+    # The files saved before the per-column counts.
+    with open(str(tmpdir.join('stats.npz')), 'wb') as f:
+        np.savez(f, count=10, mean=np.zeros(3), m2=np.ones(3) * 20.)
+    stats = RunningStats.load(str(tmpdir.join('stats.npz')))
+    np.testing.assert_array_equal(stats.count, [10, 10, 10])
+    np.testing.assert_allclose(stats.variance, [2., 2., 2.])